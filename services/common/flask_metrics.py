@@ -0,0 +1,27 @@
+import time
+
+from flask import g, request
+from prometheus_client import Histogram
+
+
+def instrument_flask(app, prefix):
+    """Registra <prefix>_http_request_duration_seconds por metodo y ruta (la regla de la URL,
+    no el path, para acotar la cardinalidad) con hooks before/after_request en la app.
+    """
+    http_request_seconds = Histogram(
+        f"{prefix}_http_request_duration_seconds",
+        "Latencia de handlers HTTP",
+        ["method", "route"],
+    )
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request_latency(response):
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        http_request_seconds.labels(method=request.method, route=route).observe(time.perf_counter() - g.request_started)
+        return response
+
+    return http_request_seconds
@@ -0,0 +1,596 @@
+import collections
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+import pika
+from pika.exceptions import ChannelClosedByBroker
+from prometheus_client import Counter, Gauge, Histogram
+
+
+JSON_PROPERTIES = {"content_type": "application/json", "delivery_mode": 2}
+
+# Identidad de la replica en los pongs; en Docker el hostname es el id del contenedor
+INSTANCE_ID = os.getenv("INSTANCE_ID") or socket.gethostname()
+HEALTH_QUEUE_EXPIRES_MS = int(os.getenv("HEALTH_QUEUE_EXPIRES_MS", "60000"))
+
+
+def health_queue_name(prefix):
+    return f"{prefix}.{INSTANCE_ID}"
+
+
+class PublishNotConfirmed(Exception):
+    """El broker no confirmo el lote: nack, canal caido o sin confirm dentro del timeout."""
+
+
+def declare_health_queue(channel, prefix):
+    """Cola de pings propia de la replica: cada instancia recibe todos los pings (una cola
+    compartida los repartiria entre replicas). No es durable, guarda solo el ultimo ping y
+    RabbitMQ la borra si la replica desaparece. La cola compartida <prefix> de versiones
+    anteriores la retira el monitor una sola vez (drop_unused_queues), no cada replica.
+    """
+    queue_name = health_queue_name(prefix)
+    channel.queue_declare(
+        queue=queue_name,
+        arguments={
+            "x-expires": HEALTH_QUEUE_EXPIRES_MS,
+            "x-max-length": 1,
+            "x-overflow": "drop-head",
+        },
+    )
+    channel.queue_bind(exchange="control.ping", queue=queue_name, routing_key="health.ping")
+    return queue_name
+
+
+def drop_unused_queues(connection, queues):
+    """Borra las colas sin consumidores (if_unused: lo decide el broker de forma atomica) y
+    devuelve las que siguen en uso, p. ej. por replicas viejas durante un rolling deploy.
+    """
+    in_use = []
+    for queue_name in queues:
+        channel = connection.channel()
+        try:
+            channel.queue_delete(queue=queue_name, if_unused=True)
+        except ChannelClosedByBroker as exc:
+            # 406 PRECONDITION_FAILED: tiene consumidores; el broker ya cerro el canal
+            if exc.reply_code != 406:
+                raise
+            in_use.append(queue_name)
+        else:
+            channel.close()
+    return in_use
+
+
+class _ConfirmBatch:
+    """Mensajes de una llamada a publish_async; on_done corre al confirmarse el ultimo."""
+
+    __slots__ = ("remaining", "error", "on_done", "logger")
+
+    def __init__(self, size, on_done, logger):
+        self.remaining = size
+        self.error = None
+        self.on_done = on_done
+        self.logger = logger
+
+    def settle(self, error=None):
+        if self.remaining <= 0:
+            return
+        if error is not None and self.error is None:
+            self.error = error
+        self.remaining -= 1
+        if self.remaining == 0:
+            self._finish()
+
+    def fail(self, error):
+        if self.remaining <= 0:
+            return
+        self.remaining = 0
+        self.error = error
+        self._finish()
+
+    def _finish(self):
+        try:
+            self.on_done(self.error)
+        except Exception:
+            self.logger.exception("Callback de confirm de publicacion fallido")
+
+
+class _ConfirmChannel:
+    """Canal de publicacion en modo confirm con conexion (SelectConnection) e hilo de IO propios.
+
+    Cada mensaje publicado recibe el siguiente delivery tag del canal y queda pendiente hasta
+    que el broker lo confirma; un Basic.Ack con multiple=True cubre todos los tags hasta el
+    indicado (marca de agua), asi que un lote espera un solo ida y vuelta y los lotes de
+    distintos hilos comparten el canal en vuelo. Si el canal o la conexion se caen, lo
+    pendiente falla con PublishNotConfirmed y el hilo reconecta con backoff.
+    """
+
+    def __init__(self, client, index):
+        self._client = client
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        # Lotes entregados al hilo de IO que aun no se publicaron
+        self._submitted = set()
+        self._delivery_tag = 0
+        self._unconfirmed = collections.OrderedDict()
+        self._close_reason = None
+        self._was_ready = False
+        self._thread = threading.Thread(
+            target=self._run, name=f"{client.service}-publisher-{index}", daemon=True
+        )
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        self._thread.start()
+
+    def wait_ready(self, timeout):
+        return self._ready.wait(timeout)
+
+    def submit(self, bodies, batch):
+        """Entrega el lote al hilo de IO; publicar en un canal asincrono solo es seguro desde alli."""
+        with self._lock:
+            if self._connection is None or not self._ready.is_set():
+                raise PublishNotConfirmed("canal de publicacion reconectando")
+            self._submitted.add(batch)
+            self._connection.ioloop.add_callback_threadsafe(functools.partial(self._publish, bodies, batch))
+
+    def _publish(self, bodies, batch):
+        with self._lock:
+            if batch not in self._submitted:
+                return
+            self._submitted.discard(batch)
+        channel = self._channel
+        if channel is None or not channel.is_open:
+            batch.fail(PublishNotConfirmed("canal de publicacion cerrado"))
+            return
+        try:
+            for exchange, routing_key, body, properties in bodies:
+                channel.basic_publish(exchange, routing_key, body, properties)
+                self._delivery_tag += 1
+                self._unconfirmed[self._delivery_tag] = batch
+                self._client.publish_unconfirmed.inc()
+        except Exception as exc:
+            batch.fail(PublishNotConfirmed(f"publicacion fallida: {exc}"))
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        error = None
+        if not isinstance(method, pika.spec.Basic.Ack):
+            error = PublishNotConfirmed("el broker rechazo la publicacion (nack)")
+        if method.multiple:
+            settled = 0
+            while self._unconfirmed and next(iter(self._unconfirmed)) <= method.delivery_tag:
+                self._unconfirmed.popitem(last=False)[1].settle(error)
+                settled += 1
+        else:
+            batch = self._unconfirmed.pop(method.delivery_tag, None)
+            settled = 0 if batch is None else 1
+            if batch is not None:
+                batch.settle(error)
+        self._client.publish_unconfirmed.dec(settled)
+
+    def _fail_unconfirmed(self, reason):
+        error = PublishNotConfirmed(f"canal de publicacion cerrado sin confirmar: {reason}")
+        for batch in self._unconfirmed.values():
+            batch.fail(error)
+        self._client.publish_unconfirmed.dec(len(self._unconfirmed))
+        self._unconfirmed.clear()
+
+    def _run(self):
+        client = self._client
+        attempt = 0
+        while True:
+            if not client._topology_declared:
+                client.connect("publisher").close()
+            self._close_reason = None
+            self._was_ready = False
+            try:
+                self._connection = pika.SelectConnection(
+                    client._params,
+                    on_open_callback=self._on_connection_open,
+                    on_open_error_callback=self._on_connection_error,
+                    on_close_callback=self._on_connection_closed,
+                )
+                self._connection.ioloop.start()
+            except Exception as exc:
+                self._close_reason = exc
+            # Lo encolado despues de que el ioloop se detuvo ya no corre: se falla aqui
+            with self._lock:
+                self._ready.clear()
+                self._connection = None
+                stale, self._submitted = self._submitted, set()
+            self._channel = None
+            for batch in stale:
+                batch.fail(PublishNotConfirmed(f"canal de publicacion cerrado: {self._close_reason}"))
+            self._fail_unconfirmed(self._close_reason)
+            if self._was_ready:
+                attempt = 0
+            delay = client.backoff_secs(attempt)
+            client._logger.warning("Canal de publicacion %s reconectando en %.1fs: %s", client.service, delay, self._close_reason)
+            client.reconnects_total.labels(role="publisher").inc()
+            attempt += 1
+            time.sleep(delay)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, exc):
+        self._close_reason = exc
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        self._ready.clear()
+        self._close_reason = reason
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(
+            self._on_delivery_confirmation,
+            callback=functools.partial(self._on_confirm_selected, channel),
+        )
+
+    def _on_confirm_selected(self, channel, _frame):
+        self._delivery_tag = 0
+        self._channel = channel
+        self._was_ready = True
+        self._ready.set()
+
+    def _on_channel_closed(self, channel, reason):
+        self._ready.clear()
+        self._channel = None
+        self._client._forget_topology(reason)
+        self._fail_unconfirmed(reason)
+        connection = self._connection
+        if connection is not None and not (connection.is_closing or connection.is_closed):
+            connection.close()
+
+
+class RabbitClient:
+    """Conexiones RabbitMQ de un servicio: pool de canales de publicacion, reconexion con
+    backoff exponencial con jitter, topologia declarada una vez y metricas por cola.
+
+    Los canales de publicacion trabajan en modo confirm sobre conexiones asincronas propias
+    (ver _ConfirmChannel): un lote de publish_many espera los confirms de todos sus mensajes
+    juntos, en vez de un ida y vuelta por mensaje como BlockingChannel en confirm_delivery.
+    """
+
+    def __init__(
+        self,
+        service,
+        metrics_prefix,
+        topology,
+        host,
+        user,
+        password,
+        publish_channels=2,
+        heartbeat=30,
+        reconnect_base_secs=0.5,
+        reconnect_max_secs=10.0,
+        confirm_timeout_secs=30.0,
+        logger=None,
+    ):
+        self.service = service
+        self._topology = topology
+        self._params = pika.ConnectionParameters(
+            host=host,
+            credentials=pika.PlainCredentials(user, password),
+            heartbeat=heartbeat,
+        )
+        self._reconnect_base_secs = reconnect_base_secs
+        self._reconnect_max_secs = reconnect_max_secs
+        self._confirm_timeout_secs = confirm_timeout_secs
+        self._logger = logger or logging.getLogger(service)
+        self._topology_lock = threading.Lock()
+        self._topology_declared = False
+        # Entregas de negocio recibidas y aun sin ack/nack (en el handler, en un lote o esperando
+        # confirms), en orden de llegada: (id del canal, delivery_tag) -> instante de llegada
+        self._pending_lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        # Los canales conectan en su hilo de IO al primer start()/publish
+        self._publishers = [_ConfirmChannel(self, index) for index in range(max(publish_channels, 1))]
+        self._next_publisher = itertools.count()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+        self.handler_seconds = Histogram(
+            f"{metrics_prefix}_message_handler_duration_seconds",
+            "Latencia de handlers de mensajes RabbitMQ",
+            ["queue"],
+        )
+        self.consumed_total = Counter(
+            f"{metrics_prefix}_messages_consumed_total",
+            "Mensajes entregados a handlers RabbitMQ",
+            ["queue", "outcome"],
+        )
+        self.publish_seconds = Histogram(
+            f"{metrics_prefix}_publish_duration_seconds",
+            "Latencia de publicacion en RabbitMQ",
+            ["exchange"],
+        )
+        self.publish_batch_messages = Histogram(
+            f"{metrics_prefix}_publish_batch_messages",
+            "Mensajes por lote confirmado por el broker",
+            buckets=(1, 2, 5, 10, 20, 40, 80, 160),
+        )
+        self.publish_unconfirmed = Gauge(
+            f"{metrics_prefix}_publish_unconfirmed_messages",
+            "Mensajes publicados esperando el confirm del broker",
+        )
+        self.reconnects_total = Counter(
+            f"{metrics_prefix}_rabbit_reconnects_total",
+            "Reconexiones a RabbitMQ",
+            ["role"],
+        )
+
+    def open_connection(self):
+        return pika.BlockingConnection(self._params)
+
+    def backoff_secs(self, attempt):
+        # Full jitter: las replicas no reconectan todas a la vez tras una caida del broker
+        return random.uniform(0, min(self._reconnect_max_secs, self._reconnect_base_secs * 2 ** attempt))
+
+    def connect(self, role):
+        """Abre una conexion con la topologia lista, reintentando hasta que RabbitMQ responda."""
+        attempt = 0
+        while True:
+            try:
+                connection = self.open_connection()
+                if not self._topology_declared:
+                    with connection.channel() as channel:
+                        self.ensure_topology(channel)
+                return connection
+            except Exception as exc:
+                delay = self.backoff_secs(attempt)
+                self._logger.warning("Esperando RabbitMQ (%s, %s): %s; reintento en %.1fs", self.service, role, exc, delay)
+                self.reconnects_total.labels(role=role).inc()
+                attempt += 1
+                time.sleep(delay)
+
+    def ensure_topology(self, channel):
+        if self._topology_declared:
+            return
+        with self._topology_lock:
+            if not self._topology_declared:
+                self._topology(channel)
+                self._topology_declared = True
+
+    def _forget_topology(self, exc):
+        # 404: alguien borro una cola o exchange; se vuelve a declarar en la proxima conexion
+        if isinstance(exc, ChannelClosedByBroker) and exc.reply_code == 404:
+            self._topology_declared = False
+
+    def start(self):
+        """Conecta los canales de publicacion (y declara la topologia) antes de arrancar los hilos."""
+        with self._start_lock:
+            if self._started:
+                return
+            for publisher in self._publishers:
+                publisher.start()
+            self._started = True
+        self._publishers[0].wait_ready(None)
+        self._logger.info("Canales RabbitMQ de publicacion listos en %s", self.service)
+
+    def _pick_publisher(self):
+        if not self._started:
+            self.start()
+        first = next(self._next_publisher)
+        for offset in range(len(self._publishers)):
+            publisher = self._publishers[(first + offset) % len(self._publishers)]
+            if publisher.ready:
+                return publisher
+        # Todos reconectando: se espera al que tocaba por turno
+        publisher = self._publishers[first % len(self._publishers)]
+        if not publisher.wait_ready(self._confirm_timeout_secs):
+            raise PublishNotConfirmed(f"sin canal de publicacion RabbitMQ en {self.service}")
+        return publisher
+
+    def publish(self, exchange, routing_key, payload, headers=None):
+        self.publish_many([(exchange, routing_key, payload, headers)])
+
+    def publish_async(self, messages, on_done):
+        """Publica (exchange, routing_key, payload[, headers]) sin esperar al broker.
+
+        payload puede venir ya serializado (bytes). on_done(error) corre una vez en el hilo de
+        IO del canal cuando el broker confirmo todo el lote (error None) o no pudo hacerlo
+        (PublishNotConfirmed); no debe bloquear. Si no hay canal disponible la excepcion se
+        lanza aqui y on_done no se llama.
+        """
+        if not messages:
+            on_done(None)
+            return
+        timer = self.publish_seconds.labels(exchange="+".join(sorted({message[0] for message in messages})))
+        bodies = [
+            (
+                exchange,
+                routing_key,
+                payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8"),
+                pika.BasicProperties(headers=headers[0] if headers else None, **JSON_PROPERTIES),
+            )
+            for exchange, routing_key, payload, *headers in messages
+        ]
+        started = time.perf_counter()
+
+        def settle(error):
+            timer.observe(time.perf_counter() - started)
+            if error is None:
+                self.publish_batch_messages.observe(len(bodies))
+            on_done(error)
+
+        self._pick_publisher().submit(bodies, _ConfirmBatch(len(bodies), settle, self._logger))
+
+    def publish_many(self, messages):
+        """Publica un lote y retorna cuando el broker confirmo todos sus mensajes.
+
+        Si el lote no se confirma se reintenta una vez en otro canal: lo que el broker ya
+        habia aceptado puede llegar dos veces (at-least-once, los consumidores deduplican);
+        si vuelve a fallar la excepcion llega al llamador, que no debe hacer ack.
+        """
+        for attempt in range(2):
+            done = threading.Event()
+            outcome = []
+
+            def settle(error, done=done, outcome=outcome):
+                outcome.append(error)
+                done.set()
+
+            try:
+                self.publish_async(messages, settle)
+                if not done.wait(self._confirm_timeout_secs):
+                    raise PublishNotConfirmed(f"sin confirm de RabbitMQ en {self._confirm_timeout_secs:.0f}s")
+                if outcome[0] is not None:
+                    raise outcome[0]
+                return
+            except PublishNotConfirmed as exc:
+                if attempt:
+                    raise
+                self._logger.warning("Publicacion sin confirmar en %s, reintento en otro canal: %s", self.service, exc)
+
+    def publish_on(self, channel, exchange, routing_key, payload):
+        """Publica sin persistencia ni confirm en un canal de consumo (pongs del carril de salud)."""
+        with self.publish_seconds.labels(exchange=exchange).time():
+            channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=json.dumps(payload).encode("utf-8"),
+                properties=pika.BasicProperties(content_type="application/json"),
+            )
+
+    def ack(self, channel, delivery_tag, multiple=False):
+        """basic_ack que ademas saca las entregas de las pendientes; corre en el hilo del canal."""
+        channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+        self._settled(channel, delivery_tag, multiple)
+
+    def nack(self, channel, delivery_tag, multiple=False, requeue=True):
+        channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+        self._settled(channel, delivery_tag, multiple)
+
+    def _settled(self, channel, delivery_tag, multiple):
+        key = (id(channel), delivery_tag)
+        with self._pending_lock:
+            if not multiple:
+                self._pending.pop(key, None)
+                return
+            for pending in [k for k in self._pending if k[0] == key[0] and k[1] <= delivery_tag]:
+                del self._pending[pending]
+
+    def _forget_pending(self, channel):
+        # RabbitMQ reentrega lo que quedo sin ack en un canal caido
+        with self._pending_lock:
+            for pending in [k for k in self._pending if k[0] == id(channel)]:
+                del self._pending[pending]
+
+    def oldest_pending_secs(self):
+        """Antiguedad de la entrega de negocio sin ack mas vieja; 0 si no hay ninguna."""
+        with self._pending_lock:
+            received = next(iter(self._pending.values()), None)
+        return 0.0 if received is None else time.monotonic() - received
+
+    def _instrument(self, queue_name, callback, track_pending):
+        timer = self.handler_seconds.labels(queue=queue_name)
+
+        @functools.wraps(callback)
+        def handle(ch, method, properties, body):
+            started = time.perf_counter()
+            if track_pending:
+                with self._pending_lock:
+                    self._pending[(id(ch), method.delivery_tag)] = time.monotonic()
+            try:
+                callback(ch, method, properties, body)
+            except Exception:
+                self.consumed_total.labels(queue=queue_name, outcome="error").inc()
+                raise
+            else:
+                self.consumed_total.labels(queue=queue_name, outcome="ok").inc()
+            finally:
+                timer.observe(time.perf_counter() - started)
+
+        return handle
+
+    def consume_health(self, queue_name, saturation_secs, on_pong=None):
+        """Carril de pings: conexion, hilo y prefetch propios, para que un handler de negocio
+        lento no demore el pong; ese atraso se reporta aparte como saturacion.
+
+        La replica esta saturada (ocupada pero viva) si su entrega de negocio sin ack mas vieja
+        lleva mas de saturation_secs. La ventana de prefetch llena no alcanza: a plena carga
+        sana tambien lo esta, pero cada entrega sale rapido.
+        """
+
+        def on_ping(ch, method, _properties, body):
+            try:
+                ping = json.loads(body.decode("utf-8"))
+                pong = {
+                    "eventType": "HealthPong",
+                    "service": self.service,
+                    "instanceId": INSTANCE_ID,
+                    "pingId": ping.get("pingId"),
+                    "saturated": self.oldest_pending_secs() > saturation_secs,
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                }
+                # En el mismo canal del carril de salud: el pong no compite por el pool de publicacion
+                self.publish_on(ch, "control.pong", "health.pong", pong)
+                if on_pong is not None:
+                    on_pong()
+            finally:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        self.consume({queue_name: on_ping}, 1, track_pending=False)
+
+    def consume(self, handlers, prefetch, on_connect=None, track_pending=True):
+        """Consume {cola: callback} para siempre; on_connect(channel) corre en cada reconexion.
+
+        Con track_pending cada entrega cuenta como pendiente hasta que el servicio la cierre con
+        ack()/nack() de este cliente: de ahi sale la saturacion que informa consume_health.
+
+        Una excepcion en un callback sale de start_consuming: se cierra la conexion (RabbitMQ
+        reentrega lo que quedo sin ack en la ventana de prefetch) y se reconecta con backoff.
+        """
+        attempt = 0
+        while True:
+            connection = None
+            channel = None
+            try:
+                connection = self.connect("consumer")
+                channel = connection.channel()
+                if on_connect is not None:
+                    on_connect(channel)
+                channel.basic_qos(prefetch_count=prefetch)
+                for queue_name, callback in handlers.items():
+                    channel.basic_consume(
+                        queue=queue_name,
+                        on_message_callback=self._instrument(queue_name, callback, track_pending),
+                    )
+                self._logger.info("Consumidor RabbitMQ de %s activo", self.service)
+                attempt = 0
+                channel.start_consuming()
+                reason = "consumo detenido"
+            except Exception as exc:
+                self._forget_topology(exc)
+                reason = exc
+            finally:
+                if channel is not None:
+                    self._forget_pending(channel)
+                # Sin cerrar, la conexion vieja y su ventana sin ack quedarian abiertas hasta el GC
+                # o el timeout de heartbeat
+                if connection is not None and connection.is_open:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            delay = self.backoff_secs(attempt)
+            self._logger.warning("Consumidor %s reiniciando en %.1fs: %s", self.service, delay, reason)
+            self.reconnects_total.labels(role="consumer").inc()
+            attempt += 1
+            time.sleep(delay)
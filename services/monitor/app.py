@@ -1,13 +1,19 @@
+import heapq
 import json
+import math
 import os
 import threading
 import time
 import uuid
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
 
-import pika
-from flask import Flask, jsonify
-from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, generate_latest
+from flask import Flask, Response, jsonify, request
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from common.flask_metrics import instrument_flask
+from common.messaging import PublishNotConfirmed, RabbitClient, drop_unused_queues
 
 
 APP_NAME = "monitor"
@@ -15,11 +21,45 @@ PORT = int(os.getenv("PORT", "8080"))
 RABBIT_HOST = os.getenv("RABBIT_HOST", "rabbitmq")
 RABBIT_USER = os.getenv("RABBIT_USER", "guest")
 RABBIT_PASS = os.getenv("RABBIT_PASS", "guest")
-PING_INTERVAL = int(os.getenv("PING_INTERVAL_SECS", "10"))
-DETECTION_WINDOW = int(os.getenv("DETECTION_WINDOW_SECS", "20"))
+RABBIT_PUBLISH_CHANNELS = int(os.getenv("RABBIT_PUBLISH_CHANNELS", "1"))
+PING_INTERVAL = float(os.getenv("PING_INTERVAL_SECS", "10"))
+DETECTION_WINDOW = float(os.getenv("DETECTION_WINDOW_SECS", "20"))
 TRACKED_SERVICES = [svc.strip() for svc in os.getenv("TRACKED_SERVICES", "reservas,pagos").split(",")]
+# Ventana por servicio, ej. "pagos=5,reservas=20"; el resto usa DETECTION_WINDOW_SECS
+SERVICE_WINDOWS = {
+    svc.strip(): float(secs)
+    for svc, _sep, secs in (item.partition("=") for item in os.getenv("SERVICE_WINDOWS_SECS", "").split(","))
+    if secs.strip()
+}
+# Liveness por instancia: el servicio esta "up" con al menos ese quorum de replicas vivas,
+# "degraded" con menos y "down" sin ninguna
+LIVENESS_QUORUM = float(os.getenv("LIVENESS_QUORUM", "0.5"))
+INSTANCE_FORGET_SECS = float(os.getenv("INSTANCE_FORGET_SECS", "300"))
+MAX_INSTANCES = int(os.getenv("MAX_INSTANCES", "2000"))
+# Timeline en memoria e historial de incidentes. TIMELINE_SIZE es por servicio: con una muestra
+# cada TIMELINE_SAMPLE_SECS=1 cada servicio guarda 24 h (unos 17 bytes por muestra)
+TIMELINE_SIZE = int(os.getenv("TIMELINE_SIZE", "86400"))
+TIMELINE_SAMPLE_SECS = float(os.getenv("TIMELINE_SAMPLE_SECS", "1.0"))
+INCIDENTS_MAX = int(os.getenv("INCIDENTS_MAX", "500"))
+# RTT ping->pong por el carril de salud (cola, conexion e hilo propios de cada replica): mide la
+# latencia del broker, la red y ese carril, no el backlog del consumidor de negocio, que llega
+# aparte como "saturated" en el pong. El carril es "lento" si el percentil RTT_SLOW_PERCENTILE
+# de los ultimos RTT supera el umbral.
+RTT_WINDOW_SIZE = int(os.getenv("RTT_WINDOW_SIZE", "50"))
+RTT_SLOW_PERCENTILE = float(os.getenv("RTT_SLOW_PERCENTILE", "0.95"))
+RTT_SLOW_THRESHOLD_SECS = float(os.getenv("RTT_SLOW_THRESHOLD_SECS", "2.0"))
+RTT_MIN_SAMPLES = 5
+# Colas de pings compartidas de versiones anteriores (antes de las colas por replica):
+# el monitor las borra cuando quedan sin consumidores y reintenta mientras sigan en uso
+LEGACY_HEALTH_QUEUES = [
+    q.strip()
+    for q in os.getenv("LEGACY_HEALTH_QUEUES", "reservas.monitor,payments.monitor,validator.monitor").split(",")
+    if q.strip()
+]
+LEGACY_QUEUE_RETRY_SECS = float(os.getenv("LEGACY_QUEUE_RETRY_SECS", "60"))
 
 app = Flask(__name__)
+instrument_flask(app, "monitor")
 
 pings_sent_total = Counter("monitor_pings_sent_total", "Pings enviados por monitor")
 pongs_received_total = Counter(
@@ -33,21 +73,46 @@ degradation_alerts_total = Counter(
     ["service"],
 )
 service_up = Gauge("monitor_service_up", "Servicio reportado como disponible", ["service"])
+service_degraded = Gauge("monitor_service_degraded", "Servicio con replicas vivas por debajo del quorum", ["service"])
+service_instances = Gauge("monitor_service_instances", "Replicas conocidas por estado", ["service", "state"])
+instances_lost_total = Counter(
+    "monitor_instances_lost_total",
+    "Replicas que dejaron de responder pings",
+    ["service"],
+)
+instances_rejected_total = Counter("monitor_instances_rejected_total", "Pongs de replicas nuevas con la tabla llena")
+ping_rtt_seconds = Histogram(
+    "monitor_ping_rtt_seconds",
+    "Tiempo ida y vuelta ping -> pong medido en monitor",
+    ["service"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0),
+)
+service_saturated = Gauge(
+    "monitor_service_saturated",
+    "Servicio con replicas vivas que reportan consumo de negocio saturado",
+    ["service"],
+)
+heartbeat_lane_slow = Gauge(
+    "monitor_heartbeat_lane_slow",
+    "RTT del carril de salud sobre el umbral (latencia de broker/red, no backlog del consumidor)",
+    ["service"],
+)
+pongs_unmatched_total = Counter(
+    "monitor_pongs_unmatched_total",
+    "Pongs de pings desconocidos o ya vencidos",
+    ["service"],
+)
 last_seen_seconds = Gauge("monitor_service_last_seen_seconds", "Ultimo pong recibido", ["service"])
 
 _last_pong_ts = {svc: 0.0 for svc in TRACKED_SERVICES}
-_publish_lock = threading.Lock()
-_publish_channel = None
 
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def rabbit_connection():
-    credentials = pika.PlainCredentials(RABBIT_USER, RABBIT_PASS)
-    params = pika.ConnectionParameters(host=RABBIT_HOST, credentials=credentials, heartbeat=30)
-    return pika.BlockingConnection(params)
+def iso(ts):
+    return None if ts is None else datetime.fromtimestamp(ts, timezone.utc).isoformat()
 
 
 def setup_topology(channel):
@@ -58,29 +123,398 @@ def setup_topology(channel):
     channel.queue_bind(exchange="control.pong", queue="monitor.pong", routing_key="health.pong")
 
 
-def connect_publish_channel():
-    global _publish_channel
-    while _publish_channel is None:
-        try:
-            connection = rabbit_connection()
-            channel = connection.channel()
-            setup_topology(channel)
-            _publish_channel = channel
-            app.logger.info("Canal RabbitMQ de publicacion listo en monitor")
-        except Exception as exc:
-            app.logger.warning("Esperando RabbitMQ en monitor: %s", exc)
-            time.sleep(2)
-
-
-def publish(exchange, routing_key, payload):
-    with _publish_lock:
-        if _publish_channel is None:
-            connect_publish_channel()
-        _publish_channel.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
-            body=json.dumps(payload).encode("utf-8"),
-            properties=pika.BasicProperties(content_type="application/json", delivery_mode=2),
+rabbit = RabbitClient(
+    APP_NAME,
+    "monitor",
+    setup_topology,
+    RABBIT_HOST,
+    RABBIT_USER,
+    RABBIT_PASS,
+    publish_channels=RABBIT_PUBLISH_CHANNELS,
+    logger=app.logger,
+)
+
+
+class DeadlineScheduler:
+    """Deadlines por clave en un heap: un hilo duerme hasta el proximo vencimiento y llama
+    on_expired(key) en ese instante. Reprogramar una clave deja obsoleta la entrada anterior,
+    que se descarta al salir del heap (a lo sumo una ventana de pongs por clave).
+    """
+
+    def __init__(self, on_expired):
+        self._on_expired = on_expired
+        self._heap = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+
+    def schedule(self, key, deadline):
+        with self._cond:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+            if self._heap[0] == (deadline, key):
+                self._cond.notify()
+
+    def run(self):
+        while True:
+            expired = []
+            with self._cond:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, key = heapq.heappop(self._heap)
+                    if self._deadlines.get(key) == deadline:
+                        del self._deadlines[key]
+                        expired.append(key)
+                if not expired:
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                    continue
+            for key in expired:
+                self._on_expired(key)
+
+
+def detection_window(service):
+    return SERVICE_WINDOWS.get(service, DETECTION_WINDOW)
+
+
+class InstanceState:
+    __slots__ = ("last_seen", "alive", "saturated")
+
+    def __init__(self, last_seen):
+        self.last_seen = last_seen
+        self.alive = True
+        self.saturated = False
+
+
+class InstanceTable:
+    """Liveness por (servicio, instancia) con contadores por servicio: cada pong o vencimiento
+    es O(1) y devuelve (estado previo, estado nuevo, vivas, conocidas, saturadas) del servicio. Las
+    replicas caidas se olvidan pasado INSTANCE_FORGET_SECS; la tabla no supera max_instances.
+    """
+
+    def __init__(self, services, max_instances, quorum):
+        self._instances = {}
+        self._alive = {service: 0 for service in services}
+        self._known = {service: 0 for service in services}
+        self._saturated = {service: 0 for service in services}
+        self._max_instances = max_instances
+        self._quorum = quorum
+        self._lock = threading.Lock()
+
+    def _state(self, service):
+        alive = self._alive[service]
+        if alive == 0:
+            return "down"
+        if alive >= math.ceil(self._known[service] * self._quorum):
+            return "up"
+        return "degraded"
+
+    def _summary(self, service, before):
+        return before, self._state(service), self._alive[service], self._known[service], self._saturated[service]
+
+    def _set_saturated(self, service, entry, saturated):
+        if entry.saturated != saturated:
+            entry.saturated = saturated
+            self._saturated[service] += 1 if saturated else -1
+
+    def record_pong(self, key, now, saturated=False):
+        service = key[0]
+        with self._lock:
+            before = self._state(service)
+            entry = self._instances.get(key)
+            if entry is None:
+                if len(self._instances) >= self._max_instances:
+                    return None
+                entry = self._instances[key] = InstanceState(now)
+                self._known[service] += 1
+                self._alive[service] += 1
+            else:
+                if not entry.alive:
+                    entry.alive = True
+                    self._alive[service] += 1
+                entry.last_seen = now
+            self._set_saturated(service, entry, saturated)
+            return self._summary(service, before)
+
+    def expire(self, key):
+        """Vencio el deadline: una replica viva pasa a caida (devuelve True); una ya caida se olvida."""
+        service = key[0]
+        with self._lock:
+            entry = self._instances.get(key)
+            if entry is None:
+                return False, None
+            before = self._state(service)
+            went_down = entry.alive
+            if went_down:
+                entry.alive = False
+                self._alive[service] -= 1
+                self._set_saturated(service, entry, False)
+            else:
+                del self._instances[key]
+                self._known[service] -= 1
+            return went_down, self._summary(service, before)
+
+    def state(self, service):
+        with self._lock:
+            return self._state(service), self._alive[service], self._known[service], self._saturated[service]
+
+    def snapshot(self, now):
+        with self._lock:
+            return [
+                {
+                    "service": service,
+                    "instanceId": instance_id,
+                    "alive": entry.alive,
+                    "saturated": entry.saturated,
+                    "lastPongLagSeconds": round(now - entry.last_seen, 3),
+                }
+                for (service, instance_id), entry in self._instances.items()
+            ]
+
+
+_instances = InstanceTable(TRACKED_SERVICES, MAX_INSTANCES, LIVENESS_QUORUM)
+
+
+class _TimelineRing:
+    __slots__ = ("ts", "lag", "healthy", "next", "count")
+
+    def __init__(self, size):
+        self.ts = array("d", bytes(8 * size))
+        self.lag = array("d", bytes(8 * size))
+        self.healthy = array("b", bytes(size))
+        self.next = 0
+        self.count = 0
+
+
+class Timeline:
+    """Un ring buffer por servicio de muestras (timestamp, lag, healthy) sobre arrays de tamano
+    fijo: cada servicio guarda sus ultimas size muestras sin importar cuantos servicios haya,
+    y la memoria no depende de cuanto tiempo lleve corriendo el monitor.
+    """
+
+    def __init__(self, services, size):
+        self._size = max(size, 1)
+        self._rings = {service: _TimelineRing(self._size) for service in services}
+        self._lock = threading.Lock()
+
+    def append(self, ts, service, lag, healthy):
+        with self._lock:
+            ring = self._rings[service]
+            idx = ring.next
+            ring.ts[idx] = ts
+            ring.lag[idx] = -1.0 if lag is None else lag
+            ring.healthy[idx] = 1 if healthy else 0
+            ring.next = (idx + 1) % self._size
+            ring.count = min(ring.count + 1, self._size)
+
+    def _service_samples(self, service, since):
+        # Se copian los arrays y se recorren fuera del lock
+        with self._lock:
+            ring = self._rings[service]
+            ts, lag, healthy = ring.ts[:], ring.lag[:], ring.healthy[:]
+            start = (ring.next - ring.count) % self._size
+            count = ring.count
+        for offset in range(count):
+            idx = (start + offset) % self._size
+            if since is not None and ts[idx] < since:
+                continue
+            yield ts[idx], service, None if lag[idx] < 0 else lag[idx], bool(healthy[idx])
+
+    def samples(self, since=None, service=None):
+        """Muestras en orden cronologico, de un servicio o de todos intercaladas por timestamp."""
+        if service:
+            return self._service_samples(service, since) if service in self._rings else iter(())
+        return heapq.merge(*(self._service_samples(svc, since) for svc in self._rings), key=lambda sample: sample[0])
+
+
+class IncidentLog:
+    """Incidentes por servicio abiertos al pasar a "down" y cerrados con el primer pong.
+
+    El monitor no ve el instante real de la falla. La mejor estimacion es el primer ping que
+    el servicio ya no respondio (enviado despues del ultimo ping con pong): la falla ocurrio
+    entre ese ping y el anterior, asi que detectionSeconds (deteccion menos ese envio) estima
+    el tiempo de deteccion y su media es mttdSeconds. lastPongToDetectionSeconds, desde el
+    ultimo pong, es una cota superior. recoverySeconds va de la deteccion al primer pong.
+    Se guardan a lo sumo max_incidents.
+    """
+
+    def __init__(self, max_incidents):
+        self._incidents = deque(maxlen=max_incidents)
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def record_transition(self, service, before, after, now, last_pong, first_unanswered_ping=None):
+        with self._lock:
+            if after == "down" and service not in self._open:
+                incident = {
+                    "service": service,
+                    "lastPongAt": last_pong or None,
+                    "firstUnansweredPingAt": first_unanswered_ping,
+                    "detectedAt": now,
+                    "recoveredAt": None,
+                }
+                self._incidents.append(incident)
+                self._open[service] = incident
+            elif before == "down" and after != "down" and service in self._open:
+                self._open.pop(service)["recoveredAt"] = now
+
+    def summary(self, service=None):
+        with self._lock:
+            incidents = [dict(incident) for incident in self._incidents if service in (None, incident["service"])]
+        last_pong_detection = []
+        detection = []
+        recovery = []
+        for incident in incidents:
+            if incident["firstUnansweredPingAt"] is not None:
+                incident["detectionSeconds"] = round(incident["detectedAt"] - incident["firstUnansweredPingAt"], 3)
+                detection.append(incident["detectionSeconds"])
+            else:
+                incident["detectionSeconds"] = None
+            if incident["lastPongAt"] is not None:
+                incident["lastPongToDetectionSeconds"] = round(incident["detectedAt"] - incident["lastPongAt"], 3)
+                last_pong_detection.append(incident["lastPongToDetectionSeconds"])
+            else:
+                incident["lastPongToDetectionSeconds"] = None
+            if incident["recoveredAt"] is not None:
+                incident["recoverySeconds"] = round(incident["recoveredAt"] - incident["detectedAt"], 3)
+                recovery.append(incident["recoverySeconds"])
+            else:
+                incident["recoverySeconds"] = None
+            for field in ("lastPongAt", "firstUnansweredPingAt", "detectedAt", "recoveredAt"):
+                incident[field] = iso(incident[field])
+        return {
+            "incidents": incidents,
+            "open": sum(1 for incident in incidents if incident["recoveredAt"] is None),
+            "mttdSeconds": round(sum(detection) / len(detection), 3) if detection else None,
+            "meanLastPongToDetectionSeconds": (
+                round(sum(last_pong_detection) / len(last_pong_detection), 3) if last_pong_detection else None
+            ),
+            "mttrSeconds": round(sum(recovery) / len(recovery), 3) if recovery else None,
+        }
+
+
+class PingTracker:
+    """Pings en vuelo por pingId y ventana de RTT por servicio.
+
+    Cada ping lo responde cada replica, asi que no se borra al llegar un pong: se descarta
+    al superar max_age (la ventana de deteccion mas larga mas un intervalo de ping, para
+    conservar el primer ping sin respuesta hasta la deteccion). Memoria acotada por pings
+    en max_age y RTT_WINDOW_SIZE por servicio.
+    """
+
+    def __init__(self, services, max_age, window_size):
+        self._max_age = max_age
+        self._sent = OrderedDict()
+        # Envio del ping mas reciente que el servicio respondio (cualquier replica)
+        self._answered = {service: None for service in services}
+        self._rtts = {service: deque(maxlen=window_size) for service in services}
+        self._slow = {service: False for service in services}
+        self._lock = threading.Lock()
+
+    def sent(self, ping_id, now):
+        with self._lock:
+            self._sent[ping_id] = now
+            while self._sent and next(iter(self._sent.values())) < now - self._max_age:
+                self._sent.popitem(last=False)
+
+    def observe(self, service, ping_id, now):
+        """Registra el RTT del pong; devuelve (rtt, slow antes, slow ahora) o None si el ping no se conoce."""
+        with self._lock:
+            sent = self._sent.get(ping_id)
+            if sent is None:
+                return None
+            rtt = now - sent
+            answered = self._answered[service]
+            if answered is None or sent > answered:
+                self._answered[service] = sent
+            window = self._rtts[service]
+            window.append(rtt)
+            before = self._slow[service]
+            if len(window) >= RTT_MIN_SAMPLES:
+                self._slow[service] = percentile(sorted(window), RTT_SLOW_PERCENTILE) > RTT_SLOW_THRESHOLD_SECS
+            return rtt, before, self._slow[service]
+
+    def first_unanswered(self, service):
+        """Envio (monotonic) del primer ping posterior al ultimo respondido por el servicio; None
+        si no se envio ninguno todavia o si nunca respondio uno.
+        """
+        with self._lock:
+            answered = self._answered[service]
+            if answered is None:
+                return None
+            return next((sent for sent in self._sent.values() if sent > answered), None)
+
+    def stats(self, service):
+        with self._lock:
+            window = sorted(self._rtts[service])
+            slow = self._slow[service]
+        if not window:
+            return {"heartbeatLaneSlow": slow, "rttP50Seconds": None, "rttSlowPercentileSeconds": None}
+        return {
+            "heartbeatLaneSlow": slow,
+            "rttP50Seconds": round(percentile(window, 0.5), 4),
+            "rttSlowPercentileSeconds": round(percentile(window, RTT_SLOW_PERCENTILE), 4),
+        }
+
+
+def percentile(ordered, fraction):
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+_pings = PingTracker(
+    TRACKED_SERVICES,
+    max([DETECTION_WINDOW, *SERVICE_WINDOWS.values()]) + PING_INTERVAL,
+    RTT_WINDOW_SIZE,
+)
+_timeline = Timeline(TRACKED_SERVICES, TIMELINE_SIZE)
+_incidents = IncidentLog(INCIDENTS_MAX)
+
+
+def report_service_state(service, summary):
+    before, after, alive, known, saturated = summary
+    service_up.labels(service=service).set(0 if after == "down" else 1)
+    service_degraded.labels(service=service).set(1 if after == "degraded" else 0)
+    service_instances.labels(service=service, state="alive").set(alive)
+    service_instances.labels(service=service, state="dead").set(known - alive)
+    service_instances.labels(service=service, state="saturated").set(saturated)
+    service_saturated.labels(service=service).set(1 if saturated else 0)
+    if before != after:
+        app.logger.warning("Servicio %s: %s -> %s (%s/%s replicas vivas)", service, before, after, alive, known)
+        if after == "down":
+            degradation_alerts_total.labels(service=service).inc()
+        now = time.time()
+        # El tracker usa el reloj monotonic; el incidente, hora de pared
+        first_unanswered = _pings.first_unanswered(service)
+        if first_unanswered is not None:
+            first_unanswered = now - (time.monotonic() - first_unanswered)
+        _incidents.record_transition(service, before, after, now, _last_pong_ts.get(service), first_unanswered)
+
+
+def on_instance_deadline(key):
+    went_down, summary = _instances.expire(key)
+    if summary is None:
+        return
+    service, instance_id = key
+    if went_down:
+        instances_lost_total.labels(service=service).inc()
+        app.logger.warning("Sin pong de %s/%s dentro de %.1fs", service, instance_id, detection_window(service))
+        # Si no vuelve, la replica se olvida para que la tabla no crezca con contenedores viejos
+        _deadlines.schedule(key, time.monotonic() + INSTANCE_FORGET_SECS)
+    report_service_state(service, summary)
+
+
+_deadlines = DeadlineScheduler(on_instance_deadline)
+
+
+def report_ping_rtt(service, ping_id):
+    observed = _pings.observe(service, ping_id, time.monotonic())
+    if observed is None:
+        pongs_unmatched_total.labels(service=service).inc()
+        return
+    rtt, was_slow, slow = observed
+    ping_rtt_seconds.labels(service=service).observe(rtt)
+    if slow != was_slow:
+        heartbeat_lane_slow.labels(service=service).set(1 if slow else 0)
+        app.logger.warning(
+            "Servicio %s: RTT del carril de salud %s el umbral de %.2fs", service, "sobre" if slow else "bajo", RTT_SLOW_THRESHOLD_SECS
         )
 
 
@@ -90,30 +524,29 @@ def on_health_pong(ch, method, _properties, body):
         service = event.get("service")
         if service in _last_pong_ts:
             now = time.time()
+            # Pongs de versiones sin instanceId cuentan como una unica replica
+            key = (service, event.get("instanceId") or service)
+            # "saturated": la replica responde por su carril de salud pero el consumo de negocio esta atascado
+            summary = _instances.record_pong(key, now, bool(event.get("saturated")))
+            if summary is None:
+                instances_rejected_total.inc()
+                return
             _last_pong_ts[service] = now
             pongs_received_total.labels(service=service).inc()
-            service_up.labels(service=service).set(1)
             last_seen_seconds.labels(service=service).set(now)
+            report_service_state(service, summary)
+            _deadlines.schedule(key, time.monotonic() + detection_window(service))
+            report_ping_rtt(service, event.get("pingId"))
     finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        rabbit.ack(ch, method.delivery_tag)
 
 
 def pong_consumer_worker():
-    while True:
-        try:
-            connection = rabbit_connection()
-            channel = connection.channel()
-            setup_topology(channel)
-            channel.basic_qos(prefetch_count=20)
-            channel.basic_consume(queue="monitor.pong", on_message_callback=on_health_pong)
-            app.logger.info("Consumidor de pong activo")
-            channel.start_consuming()
-        except Exception as exc:
-            app.logger.warning("Consumidor monitor reiniciando: %s", exc)
-            time.sleep(2)
+    rabbit.consume({"monitor.pong": on_health_pong}, 20)
 
 
 def ping_worker():
+    next_ping = time.monotonic()
     while True:
         ping_id = str(uuid.uuid4())
         payload = {
@@ -122,26 +555,45 @@ def ping_worker():
             "source": APP_NAME,
             "timestamp": now_iso(),
         }
-        publish("control.ping", "health.ping", payload)
-        pings_sent_total.inc()
-        time.sleep(PING_INTERVAL)
+        _pings.sent(ping_id, time.monotonic())
+        try:
+            rabbit.publish("control.ping", "health.ping", payload)
+            pings_sent_total.inc()
+        except PublishNotConfirmed as exc:
+            # Sin ping no hay pongs: los deadlines marcan down si el broker sigue caido
+            app.logger.warning("Ping sin confirmar: %s", exc)
+        # Cadencia fija (admite intervalos sub-segundo); si una publicacion se atrasa no se acumulan pings
+        next_ping = max(next_ping + PING_INTERVAL, time.monotonic())
+        time.sleep(next_ping - time.monotonic())
+
+
+def legacy_queue_migration_worker():
+    pending = list(LEGACY_HEALTH_QUEUES)
+    while pending:
+        try:
+            connection = rabbit.connect("migration")
+            try:
+                pending = drop_unused_queues(connection, pending)
+            finally:
+                connection.close()
+        except Exception as exc:
+            app.logger.warning("Migracion de colas de pings pendiente: %s", exc)
+        if pending:
+            app.logger.info("Colas de pings compartidas aun en uso: %s", ", ".join(pending))
+            time.sleep(LEGACY_QUEUE_RETRY_SECS)
+    app.logger.info("Colas de pings compartidas retiradas")
 
 
-def degrade_check_worker():
+def timeline_worker():
+    next_sample = time.monotonic()
     while True:
         now = time.time()
         for service in TRACKED_SERVICES:
             last = _last_pong_ts.get(service, 0.0)
-            if last <= 0:
-                service_up.labels(service=service).set(0)
-                continue
-            lag = now - last
-            if lag > DETECTION_WINDOW:
-                service_up.labels(service=service).set(0)
-                degradation_alerts_total.labels(service=service).inc()
-            else:
-                service_up.labels(service=service).set(1)
-        time.sleep(5)
+            lag = None if last <= 0 else round(now - last, 3)
+            _timeline.append(now, service, lag, _instances.state(service)[0] != "down")
+        next_sample = max(next_sample + TIMELINE_SAMPLE_SECS, time.monotonic())
+        time.sleep(next_sample - time.monotonic())
 
 
 @app.get("/status")
@@ -151,9 +603,17 @@ def status():
     for service in TRACKED_SERVICES:
         last = _last_pong_ts.get(service, 0.0)
         lag = None if last <= 0 else round(now - last, 3)
+        state, alive, known, saturated = _instances.state(service)
         services[service] = {
             "lastPongLagSeconds": lag,
-            "healthy": lag is not None and lag <= DETECTION_WINDOW,
+            "detectionWindowSecs": detection_window(service),
+            "state": state,
+            "instancesAlive": alive,
+            "instancesKnown": known,
+            "instancesSaturated": saturated,
+            "saturated": saturated > 0,
+            "healthy": state != "down",
+            **_pings.stats(service),
         }
     return jsonify(
         {
@@ -165,6 +625,35 @@ def status():
     )
 
 
+@app.get("/instances")
+def instances():
+    return jsonify({"livenessQuorum": LIVENESS_QUORUM, "instances": _instances.snapshot(time.time())})
+
+
+@app.get("/timeline")
+def timeline():
+    since = request.args.get("since", type=float)
+    service = request.args.get("service")
+    if request.args.get("format", "csv") == "ndjson":
+        def ndjson():
+            for ts, svc, lag, healthy in _timeline.samples(since, service):
+                yield json.dumps({"timestamp": ts, "service": svc, "lag": lag, "healthy": healthy}) + "\n"
+
+        return Response(ndjson(), mimetype="application/x-ndjson")
+
+    def csv():
+        yield "timestamp,service,lag,healthy\n"
+        for ts, svc, lag, healthy in _timeline.samples(since, service):
+            yield f"{ts:.3f},{svc},{'' if lag is None else lag},{healthy}\n"
+
+    return Response(csv(), mimetype="text/csv")
+
+
+@app.get("/incidents")
+def incidents():
+    return jsonify(_incidents.summary(request.args.get("service")))
+
+
 @app.get("/health")
 def health():
     return jsonify({"status": "ok", "service": APP_NAME})
@@ -176,11 +665,16 @@ def metrics():
 
 
 def bootstrap():
-    connect_publish_channel()
+    for service in TRACKED_SERVICES:
+        service_up.labels(service=service).set(0)
+        heartbeat_lane_slow.labels(service=service).set(0)
+    rabbit.start()
     threads = [
         threading.Thread(target=pong_consumer_worker, daemon=True),
         threading.Thread(target=ping_worker, daemon=True),
-        threading.Thread(target=degrade_check_worker, daemon=True),
+        threading.Thread(target=_deadlines.run, daemon=True),
+        threading.Thread(target=timeline_worker, daemon=True),
+        threading.Thread(target=legacy_queue_migration_worker, daemon=True),
     ]
     for thread in threads:
         thread.start()
@@ -1,15 +1,22 @@
+import argparse
+import functools
 import json
 import os
+import sys
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone
 
-import pika
 import pybreaker
 import redis
 import requests
-from flask import Flask, jsonify
-from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, generate_latest
+from flask import Flask, jsonify, request
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from requests.adapters import HTTPAdapter
+
+from common.flask_metrics import instrument_flask
+from common.messaging import RabbitClient, declare_health_queue, health_queue_name
 
 
 APP_NAME = "pagos"
@@ -17,40 +24,160 @@ PORT = int(os.getenv("PORT", "8080"))
 RABBIT_HOST = os.getenv("RABBIT_HOST", "rabbitmq")
 RABBIT_USER = os.getenv("RABBIT_USER", "guest")
 RABBIT_PASS = os.getenv("RABBIT_PASS", "guest")
+RABBIT_PUBLISH_CHANNELS = int(os.getenv("RABBIT_PUBLISH_CHANNELS", "4"))
 REDIS_HOST = os.getenv("REDIS_HOST", "redis-server")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_PASS = os.getenv("REDIS_PASS", "admin")
 PROVIDER_URL = os.getenv("PROVIDER_URL", "http://wiremock:8080/pay")
 REQUEST_TIMEOUT_SECS = float(os.getenv("REQUEST_TIMEOUT_SECS", "2.0"))
 
+# Los pings se atienden en un carril propio; la saturacion del consumo de negocio se reporta en el pong
+SATURATION_BUSY_SECS = float(os.getenv("SATURATION_BUSY_SECS", "5.0"))
+
 # TTL controlado
 QUEUE_TTL_MS = int(os.getenv("QUEUE_TTL_MS", "30000"))  # 30s
 QUEUE_MAX_LEN = int(os.getenv("QUEUE_MAX_LEN", "10000"))
 
+# Pool de workers: las entregas se procesan en paralelo y el ack vuelve al hilo de la conexion
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", "10"))
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", str(max(PAYMENT_WORKERS, 10))))
+# Conexiones keep-alive al proveedor; por defecto una por worker
+PROVIDER_POOL_SIZE = int(os.getenv("PROVIDER_POOL_SIZE", str(PAYMENT_WORKERS)))
+
+# Modo batch opcional: agrupa cobros en un POST a PROVIDER_BATCH_URL (1 = desactivado)
+PROVIDER_BATCH_URL = os.getenv("PROVIDER_BATCH_URL", "http://wiremock:8080/pay/batch")
+PROVIDER_BATCH_SIZE = int(os.getenv("PROVIDER_BATCH_SIZE", "1"))
+PROVIDER_BATCH_WAIT_MS = float(os.getenv("PROVIDER_BATCH_WAIT_MS", "20"))
+PROVIDER_BATCH_CONCURRENCY = int(os.getenv("PROVIDER_BATCH_CONCURRENCY", "2"))
+
+# Limite adaptativo (AIMD) de llamadas concurrentes al proveedor, junto al circuit breaker
+PROVIDER_LIMIT_INITIAL = int(os.getenv("PROVIDER_LIMIT_INITIAL", str(PROVIDER_POOL_SIZE)))
+PROVIDER_LIMIT_MIN = int(os.getenv("PROVIDER_LIMIT_MIN", "1"))
+PROVIDER_LIMIT_MAX = int(os.getenv("PROVIDER_LIMIT_MAX", str(PROVIDER_POOL_SIZE)))
+PROVIDER_LATENCY_TARGET_SECS = float(os.getenv("PROVIDER_LATENCY_TARGET_SECS", "0.5"))
+PROVIDER_LIMIT_BACKOFF = float(os.getenv("PROVIDER_LIMIT_BACKOFF", "0.7"))
+PROVIDER_LIMIT_QUEUE = int(os.getenv("PROVIDER_LIMIT_QUEUE", str(PAYMENT_WORKERS)))
+PROVIDER_LIMIT_QUEUE_TIMEOUT_SECS = float(os.getenv("PROVIDER_LIMIT_QUEUE_TIMEOUT_SECS", "1.0"))
+
+# Redis: pool dimensionado a los workers y claims de idempotencia agrupados en pipelines
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", str(PAYMENT_WORKERS + 2)))
+IDEMPOTENCY_TTL_SECS = int(os.getenv("IDEMPOTENCY_TTL_SECS", "3600"))
+IDEMPOTENCY_BATCH_MAX = int(os.getenv("IDEMPOTENCY_BATCH_MAX", "50"))
+IDEMPOTENCY_BATCH_WAIT_MS = float(os.getenv("IDEMPOTENCY_BATCH_WAIT_MS", "2"))
+
+# Re-inyeccion de payments.dlq con tasa controlada (token bucket)
+DLQ_REPLAY_RATE = float(os.getenv("DLQ_REPLAY_RATE", "20"))
+DLQ_REPLAY_BURST = int(os.getenv("DLQ_REPLAY_BURST", "20"))
+# Un claim "processing" mas viejo que esto se da por huerfano (worker caido) y se re-inyecta
+DLQ_REPLAY_STALE_CLAIM_SECS = int(os.getenv("DLQ_REPLAY_STALE_CLAIM_SECS", "300"))
+
+# Reintentos sin bloquear: cola por retardo con TTL que re-encola (dead-letter) en payments.validated
+PAYMENT_RETRY_DELAYS_MS = [int(ms) for ms in os.getenv("PAYMENT_RETRY_DELAYS_MS", "1000,2000").split(",") if ms.strip()]
+ATTEMPT_HEADER = "x-payment-attempt"
+# Descartes del limitador local: vuelven con el mismo intento (el proveedor no se llamo) y un tope propio
+PAYMENT_SHED_DELAY_MS = int(os.getenv("PAYMENT_SHED_DELAY_MS", str(PAYMENT_RETRY_DELAYS_MS[0] if PAYMENT_RETRY_DELAYS_MS else 1000)))
+PAYMENT_SHED_MAX_REQUEUES = int(os.getenv("PAYMENT_SHED_MAX_REQUEUES", "30"))
+SHED_HEADER = "x-payment-shed"
+
 app = Flask(__name__)
+instrument_flask(app, "payments")
 
 payment_requested_total = Counter("payments_requested_total", "Solicitudes de pago (validadas) recibidas")
 payment_success_total = Counter("payments_success_total", "Pagos exitosos")
 payment_failed_total = Counter("payments_failed_total", "Pagos fallidos")
 payment_dlq_total = Counter("payments_dlq_total", "Mensajes enviados a DLQ")
 heartbeat_responses_total = Counter("payments_heartbeat_responses_total", "Pong emitidos por pagos")
-provider_call_seconds = Gauge("payments_provider_call_seconds", "Duracion de ultima llamada al proveedor")
+payment_retries_total = Counter(
+    "payments_retries_scheduled_total",
+    "Reintentos de pago programados en colas de retardo",
+    ["delay_ms"],
+)
+payment_shed_requeued_total = Counter(
+    "payments_shed_requeued_total",
+    "Pagos re-encolados por sobrecarga del limitador local (sin gastar reintentos)",
+)
+provider_call_latency = Histogram(
+    "payments_provider_call_latency_seconds",
+    "Latencia de llamadas al proveedor",
+    ["outcome"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0),
+)
+provider_batch_size = Histogram(
+    "payments_provider_batch_size",
+    "Pagos agrupados por llamada batch al proveedor",
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+provider_connections_opened = Gauge(
+    "payments_provider_connections_opened",
+    "Conexiones HTTP abiertas hacia el proveedor desde el arranque",
+)
+provider_requests_sent = Gauge(
+    "payments_provider_requests_sent",
+    "Requests HTTP enviados al proveedor desde el arranque",
+)
+provider_connection_reuse_ratio = Gauge(
+    "payments_provider_connection_reuse_ratio",
+    "Fraccion de requests al proveedor que reutilizaron una conexion",
+)
+provider_concurrency_limit = Gauge(
+    "payments_provider_concurrency_limit",
+    "Limite adaptativo de llamadas concurrentes al proveedor",
+)
+provider_calls_in_flight = Gauge("payments_provider_calls_in_flight", "Llamadas al proveedor en curso")
+provider_calls_queued = Gauge("payments_provider_calls_queued", "Llamadas esperando cupo del limitador")
+provider_limiter_rejections_total = Counter(
+    "payments_provider_limiter_rejections_total",
+    "Llamadas al proveedor rechazadas por el limitador",
+    ["reason"],
+)
+payments_in_flight = Gauge("payments_in_flight", "Pagos en proceso en el pool de workers")
+redis_command_seconds = Histogram(
+    "payments_redis_command_duration_seconds",
+    "Latencia de round trips a Redis",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+)
+idempotency_claims_total = Counter("payments_idempotency_claims_total", "Claves de idempotencia consultadas")
+idempotency_duplicates_total = Counter(
+    "payments_idempotency_duplicates_total",
+    "Pagos descartados por clave de idempotencia existente",
+)
+idempotency_batch_size = Histogram(
+    "payments_idempotency_batch_size",
+    "Claves resueltas por pipeline de Redis",
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+payment_processing_seconds = Histogram(
+    "payments_processing_duration_seconds",
+    "Latencia de procesamiento de una entrega en el pool de workers",
+)
+dlq_replay_messages_total = Counter(
+    "payments_dlq_replay_messages_total",
+    "Mensajes de DLQ revisados por el replay",
+    ["outcome"],
+)
+dlq_replay_remaining = Gauge("payments_dlq_replay_remaining", "Mensajes de DLQ pendientes en el replay en curso")
+dlq_replay_throughput = Gauge("payments_dlq_replay_throughput", "Mensajes por segundo del replay en curso")
 
 _redis = None
-_publish_lock = threading.Lock()
-_publish_channel = None
+_replay_lock = threading.Lock()
+_replay_job = None
+_payment_executor = ThreadPoolExecutor(max_workers=PAYMENT_WORKERS, thread_name_prefix="pagos-worker")
 
 circuit_breaker = pybreaker.CircuitBreaker(fail_max=3, reset_timeout=20)
 
+_provider_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PROVIDER_POOL_SIZE, pool_block=True)
+_provider_session = requests.Session()
+_provider_session.mount("http://", _provider_adapter)
+_provider_session.mount("https://", _provider_adapter)
+
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def rabbit_connection():
-    credentials = pika.PlainCredentials(RABBIT_USER, RABBIT_PASS)
-    params = pika.ConnectionParameters(host=RABBIT_HOST, credentials=credentials, heartbeat=30)
-    return pika.BlockingConnection(params)
+def retry_queue_name(delay_ms: int) -> str:
+    return f"payments.retry.{delay_ms}ms"
 
 
 def setup_topology(channel):
@@ -81,25 +208,46 @@ def setup_topology(channel):
         routing_key="payment.validated",
     )
 
-    channel.queue_declare(queue="payments.monitor", durable=True)
-    channel.queue_bind(
-        exchange="control.ping",
-        queue="payments.monitor",
-        routing_key="health.ping",
-    )
+    for delay_ms in sorted(set(PAYMENT_RETRY_DELAYS_MS) | {PAYMENT_SHED_DELAY_MS}):
+        channel.queue_declare(
+            queue=retry_queue_name(delay_ms),
+            durable=True,
+            arguments={
+                "x-message-ttl": delay_ms,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": "payments.validated",
+            },
+        )
+
+    declare_health_queue(channel, "payments.monitor")
+
+
+rabbit = RabbitClient(
+    APP_NAME,
+    "payments",
+    setup_topology,
+    RABBIT_HOST,
+    RABBIT_USER,
+    RABBIT_PASS,
+    publish_channels=RABBIT_PUBLISH_CHANNELS,
+    logger=app.logger,
+)
 
 
 def redis_client():
     global _redis
     while _redis is None:
         try:
-            _redis = redis.Redis(
+            pool = redis.BlockingConnectionPool(
                 host=REDIS_HOST,
                 port=REDIS_PORT,
                 password=REDIS_PASS,
                 decode_responses=True,
                 socket_timeout=2,
+                max_connections=REDIS_POOL_SIZE,
+                timeout=5,
             )
+            _redis = redis.Redis(connection_pool=pool)
             _redis.ping()
             app.logger.info("Redis listo en pagos")
         except Exception as exc:
@@ -109,139 +257,621 @@ def redis_client():
     return _redis
 
 
-def connect_publish_channel():
-    global _publish_channel
-    while _publish_channel is None:
+def processed_key(reservation_id: str) -> str:
+    return f"payments:processed:{reservation_id}"
+
+
+def claim_many(reservation_ids):
+    """SET NX de varias claves en un solo round trip; True = clave reclamada ahora."""
+    pipe = redis_client().pipeline(transaction=False)
+    for reservation_id in reservation_ids:
+        pipe.set(name=processed_key(reservation_id), value="processing", nx=True, ex=IDEMPOTENCY_TTL_SECS)
+    with redis_command_seconds.labels(operation="claim_pipeline").time():
+        results = [bool(result) for result in pipe.execute()]
+    idempotency_batch_size.observe(len(results))
+    idempotency_claims_total.inc(len(results))
+    idempotency_duplicates_total.inc(results.count(False))
+    return results
+
+
+def mark_outcome(reservation_id: str, outcome: str):
+    # "succeeded" / "failed": el replay de la DLQ decide con este valor si reintentar
+    with redis_command_seconds.labels(operation="mark_outcome").time():
+        redis_client().set(name=processed_key(reservation_id), value=outcome, ex=IDEMPOTENCY_TTL_SECS)
+
+
+class MicroBatcher:
+    """Agrupa llamadas de workers concurrentes (hasta max_batch o max_wait_ms) y las resuelve
+    con handler(items) -> resultados en el mismo orden; un resultado Exception falla solo ese item.
+    """
+
+    def __init__(self, max_batch, max_wait_ms, handler, dispatch=None):
+        self._max_batch = max_batch
+        self._max_wait = max_wait_ms / 1000.0
+        self._handler = handler
+        self._dispatch = dispatch
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, item):
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._pending.append((item, future))
+            self._cond.notify()
+        return future.result()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.time() + self._max_wait
+            while len(self._pending) < self._max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[: self._max_batch]
+            del self._pending[: self._max_batch]
+        return batch
+
+    def _resolve(self, batch):
         try:
-            connection = rabbit_connection()
-            channel = connection.channel()
-            setup_topology(channel)
-            _publish_channel = channel
-            app.logger.info("Canal RabbitMQ de publicacion listo en pagos")
+            results = self._handler([item for item, _future in batch])
         except Exception as exc:
-            app.logger.warning("Esperando RabbitMQ para publicacion: %s", exc)
-            time.sleep(2)
-
-
-def publish(exchange, routing_key, payload):
-    with _publish_lock:
-        if _publish_channel is None:
-            connect_publish_channel()
-        _publish_channel.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
-            body=json.dumps(payload).encode("utf-8"),
-            properties=pika.BasicProperties(content_type="application/json", delivery_mode=2),
-        )
-
-
-def call_provider(amount: float):
-    @circuit_breaker
-    def _inner():
-        start = time.time()
-        response = requests.post(PROVIDER_URL, json={"amount": amount}, timeout=REQUEST_TIMEOUT_SECS)
-        provider_call_seconds.set(time.time() - start)
-        if response.status_code >= 400:
-            raise RuntimeError(f"Provider status {response.status_code}")
-        return response.json()
-
-    return _inner()
+            for _item, future in batch:
+                future.set_exception(exc)
+            return
+        for (_item, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # Con dispatch, varios lotes pueden resolverse en paralelo mientras se junta el siguiente
+            if self._dispatch is not None:
+                self._dispatch.submit(self._resolve, batch)
+            else:
+                self._resolve(batch)
+
+
+_claimer = MicroBatcher(IDEMPOTENCY_BATCH_MAX, IDEMPOTENCY_BATCH_WAIT_MS, claim_many)
+
+
+def report_provider_pool():
+    pools = _provider_adapter.poolmanager.pools
+    opened = sent = 0
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            opened += pool.num_connections
+            sent += pool.num_requests
+    provider_connections_opened.set(opened)
+    provider_requests_sent.set(sent)
+    if sent:
+        provider_connection_reuse_ratio.set(1 - opened / sent)
+
+
+@circuit_breaker
+def _post_provider(url, payload):
+    start = time.time()
+    outcome = "error"
+    try:
+        response = _provider_session.post(url, json=payload, timeout=REQUEST_TIMEOUT_SECS)
+        outcome = "ok" if response.status_code < 400 else "rejected"
+    finally:
+        elapsed = time.time() - start
+        provider_call_latency.labels(outcome=outcome).observe(elapsed)
+        report_provider_pool()
+    if response.status_code >= 400:
+        raise RuntimeError(f"Provider status {response.status_code}")
+    return response.json()
+
+
+class ProviderOverloaded(RuntimeError):
+    pass
+
+
+class AdaptiveLimiter:
+    """Limite AIMD de concurrencia: +1/limite por exito rapido, *backoff por lentitud o error."""
+
+    def __init__(self, initial, min_limit, max_limit, latency_target, backoff, max_queue, queue_timeout):
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._min = min_limit
+        self._max = max_limit
+        self._latency_target = latency_target
+        self._backoff = backoff
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._report()
+
+    def _report(self):
+        provider_concurrency_limit.set(int(self._limit))
+        provider_calls_in_flight.set(self._in_flight)
+        provider_calls_queued.set(self._queued)
+
+    def acquire(self):
+        with self._cond:
+            if self._in_flight >= int(self._limit):
+                if self._queued >= self._max_queue:
+                    provider_limiter_rejections_total.labels(reason="queue_full").inc()
+                    raise ProviderOverloaded("cola del limitador llena")
+                self._queued += 1
+                self._report()
+                deadline = time.time() + self._queue_timeout
+                try:
+                    while self._in_flight >= int(self._limit):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            provider_limiter_rejections_total.labels(reason="timeout").inc()
+                            raise ProviderOverloaded("sin cupo en el limitador")
+                        self._cond.wait(remaining)
+                finally:
+                    self._queued -= 1
+            self._in_flight += 1
+            self._report()
+
+    def release(self, latency=None, ok=True):
+        with self._cond:
+            self._in_flight -= 1
+            # latency None: no hubo llamada real (p.ej. breaker abierto), no ajusta el limite
+            if latency is not None:
+                if ok and latency <= self._latency_target:
+                    self._limit = min(self._max, self._limit + 1.0 / self._limit)
+                else:
+                    self._limit = max(self._min, self._limit * self._backoff)
+            self._report()
+            self._cond.notify_all()
+
+
+_provider_limiter = AdaptiveLimiter(
+    PROVIDER_LIMIT_INITIAL,
+    PROVIDER_LIMIT_MIN,
+    PROVIDER_LIMIT_MAX,
+    PROVIDER_LATENCY_TARGET_SECS,
+    PROVIDER_LIMIT_BACKOFF,
+    PROVIDER_LIMIT_QUEUE,
+    PROVIDER_LIMIT_QUEUE_TIMEOUT_SECS,
+)
+
+
+def limited_post(url, payload):
+    # Si no hay cupo lanza ProviderOverloaded y process_payment lo reprograma como reintento
+    _provider_limiter.acquire()
+    start = time.time()
+    try:
+        result = _post_provider(url, payload)
+    except pybreaker.CircuitBreakerError:
+        _provider_limiter.release()
+        raise
+    except Exception:
+        _provider_limiter.release(time.time() - start, ok=False)
+        raise
+    _provider_limiter.release(time.time() - start, ok=True)
+    return result
+
+
+def charge_batch(items):
+    """Un POST al endpoint batch del proveedor para varios (reservation_id, amount)."""
+    payload = {
+        "items": [
+            {"id": str(idx), "reservationId": reservation_id, "amount": amount}
+            for idx, (reservation_id, amount) in enumerate(items)
+        ]
+    }
+    provider_batch_size.observe(len(items))
+    response = limited_post(PROVIDER_BATCH_URL, payload)
+    by_id = {str(result.get("id")): result for result in response.get("results", [])}
+    results = []
+    for idx in range(len(items)):
+        result = by_id.get(str(idx))
+        status = result.get("status") if result else "MISSING"
+        if status != "APPROVED":
+            results.append(RuntimeError(f"Provider item status {status}"))
+        else:
+            results.append(result)
+    return results
+
+
+_provider_batcher = MicroBatcher(
+    PROVIDER_BATCH_SIZE,
+    PROVIDER_BATCH_WAIT_MS,
+    charge_batch,
+    dispatch=ThreadPoolExecutor(max_workers=PROVIDER_BATCH_CONCURRENCY, thread_name_prefix="pagos-batch"),
+)
+
+
+def call_provider(amount: float, reservation_id: str = None):
+    if PROVIDER_BATCH_SIZE > 1:
+        return _provider_batcher.submit((reservation_id, amount))
+    return limited_post(PROVIDER_URL, {"amount": amount})
+
+
+def schedule_retry(event, attempt: int):
+    delay_ms = PAYMENT_RETRY_DELAYS_MS[attempt - 1]
+    rabbit.publish("", retry_queue_name(delay_ms), event, headers={ATTEMPT_HEADER: attempt + 1})
+    payment_retries_total.labels(delay_ms=str(delay_ms)).inc()
+
+
+def schedule_shed_retry(event, attempt: int, shed: int):
+    # Mismo intento: solo las fallas reales del proveedor gastan PAYMENT_RETRY_DELAYS_MS
+    rabbit.publish(
+        "",
+        retry_queue_name(PAYMENT_SHED_DELAY_MS),
+        event,
+        headers={ATTEMPT_HEADER: attempt, SHED_HEADER: shed + 1},
+    )
+    payment_shed_requeued_total.inc()
 
 
-def process_payment(event):
+def process_payment(event, attempt: int = 1, shed: int = 0):
     reservation_id = event["reservationId"]
     amount = float(event.get("amount", 0))
     correlation_id = event.get("correlationId", reservation_id)
 
-    cache = redis_client()
-    if not cache.set(name=f"payments:processed:{reservation_id}", value="1", nx=True, ex=3600):
-        app.logger.info("Reserva %s ya procesada; idempotencia aplicada", reservation_id)
-        return
+    # En los reintentos (y tras un descarte local) la clave de idempotencia ya es nuestra
+    if attempt == 1 and not shed:
+        if not _claimer.submit(reservation_id):
+            app.logger.info("Reserva %s ya procesada; idempotencia aplicada", reservation_id)
+            return
 
-    publish(
-        "payments.events",
-        "payment.started",
-        {
-            "eventType": "PaymentProcessingStarted",
-            "reservationId": reservation_id,
-            "correlationId": correlation_id,
-            "amount": amount,
-            "timestamp": now_iso(),
-        },
-    )
+        rabbit.publish(
+            "payments.events",
+            "payment.started",
+            {
+                "eventType": "PaymentProcessingStarted",
+                "reservationId": reservation_id,
+                "correlationId": correlation_id,
+                "amount": amount,
+                "timestamp": now_iso(),
+            },
+        )
 
-    retries = [1, 2, 4]
-    for idx, wait_secs in enumerate(retries, start=1):
-        try:
-            call_provider(amount)
-            publish(
-                "payments.events",
-                "payment.succeeded",
-                {
-                    "eventType": "PaymentSucceeded",
-                    "reservationId": reservation_id,
-                    "correlationId": correlation_id,
-                    "timestamp": now_iso(),
-                },
-            )
-            payment_success_total.inc()
+    try:
+        call_provider(amount, reservation_id)
+    except ProviderOverloaded as exc:
+        if shed < PAYMENT_SHED_MAX_REQUEUES:
+            schedule_shed_retry(event, attempt, shed)
             return
-        except Exception as exc:
-            app.logger.warning("Intento %s fallo para %s: %s", idx, reservation_id, exc)
-            if idx < len(retries):
-                time.sleep(wait_secs)
+        app.logger.warning("Reserva %s descartada %s veces por sobrecarga local: %s", reservation_id, shed, exc)
+        reason = "provider_overloaded"
+    except Exception as exc:
+        app.logger.warning("Intento %s fallo para %s: %s", attempt, reservation_id, exc)
+        if attempt <= len(PAYMENT_RETRY_DELAYS_MS):
+            # El worker queda libre: la cola de retardo devuelve el mensaje al vencer el TTL
+            schedule_retry(event, attempt)
+            return
+        reason = "provider_unavailable"
+    else:
+        rabbit.publish(
+            "payments.events",
+            "payment.succeeded",
+            {
+                "eventType": "PaymentSucceeded",
+                "reservationId": reservation_id,
+                "correlationId": correlation_id,
+                "timestamp": now_iso(),
+            },
+        )
+        mark_outcome(reservation_id, "succeeded")
+        payment_success_total.inc()
+        return
 
     fail_event = {
         "eventType": "PaymentFailed",
         "reservationId": reservation_id,
         "correlationId": correlation_id,
-        "reason": "provider_unavailable",
+        "amount": amount,
+        "reason": reason,
         "timestamp": now_iso(),
     }
-    publish("payments.events", "payment.failed", fail_event)
-    publish("payments.dlq", "payment.failed", fail_event)
+    mark_outcome(reservation_id, "failed")
+    rabbit.publish_many(
+        [
+            ("payments.events", "payment.failed", fail_event),
+            ("payments.dlq", "payment.failed", fail_event),
+        ]
+    )
     payment_failed_total.inc()
     payment_dlq_total.inc()
 
 
-def on_payment_validated(ch, method, _properties, body):
+@payment_processing_seconds.time()
+def process_delivery(connection, ch, delivery_tag, headers, body):
     try:
         event = json.loads(body.decode("utf-8"))
-        payment_requested_total.inc()
-        process_payment(event)
+        attempt = int((headers or {}).get(ATTEMPT_HEADER, 1))
+        shed = int((headers or {}).get(SHED_HEADER, 0))
+        if attempt == 1 and not shed:
+            payment_requested_total.inc()
+        process_payment(event, attempt, shed)
+    except Exception as exc:
+        app.logger.warning("Error procesando pago: %s", exc)
     finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        payments_in_flight.dec()
+        # pika no es thread-safe: el ack se ejecuta en el hilo de la conexion
+        try:
+            connection.add_callback_threadsafe(functools.partial(rabbit.ack, ch, delivery_tag))
+        except Exception as exc:
+            app.logger.warning("No se pudo confirmar entrega %s: %s", delivery_tag, exc)
 
 
-def on_health_ping(ch, method, _properties, body):
-    try:
-        ping = json.loads(body.decode("utf-8"))
-        pong = {
-            "eventType": "HealthPong",
-            "service": APP_NAME,
-            "pingId": ping.get("pingId"),
-            "timestamp": now_iso(),
-        }
-        publish("control.pong", "health.pong", pong)
-        heartbeat_responses_total.inc()
-    finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+def on_payment_validated(ch, method, properties, body):
+    payments_in_flight.inc()
+    _payment_executor.submit(process_delivery, ch.connection, ch, method.delivery_tag, properties.headers, body)
 
 
 def consumer_worker():
-    while True:
+    rabbit.consume(
+        {"payments.validated": on_payment_validated},
+        CONSUMER_PREFETCH,
+    )
+
+
+def health_worker():
+    rabbit.consume_health(
+        health_queue_name("payments.monitor"), SATURATION_BUSY_SECS, on_pong=heartbeat_responses_total.inc
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._capacity = max(burst, 1)
+        self._tokens = float(self._capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, sleep=time.sleep):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            sleep(wait)
+
+
+def dlq_replay_target(event):
+    """(exchange, routing_key, payload, headers) para re-inyectar un mensaje de la DLQ, o None.
+
+    Lo que vuelve a payments.validated arranca en el intento 1 con el presupuesto completo
+    de reintentos: el replay es una decision del operador tras arreglar la causa y el
+    replay ya libero la clave de idempotencia, asi que el intento 1 la vuelve a tomar.
+    """
+    event_type = event.get("eventType")
+    if event_type == "PaymentFailed":
+        if "amount" not in event:
+            return None
+        return (
+            "",
+            "payments.validated",
+            {
+                "eventType": "PaymentValidated",
+                "reservationId": event["reservationId"],
+                "correlationId": event.get("correlationId", event["reservationId"]),
+                "amount": event["amount"],
+                "replayed": True,
+                "timestamp": now_iso(),
+            },
+            {ATTEMPT_HEADER: 1},
+        )
+    # Expirados por TTL: vuelven a la cola de la que salieron
+    if event_type == "PaymentValidated":
+        return "", "payments.validated", event, {ATTEMPT_HEADER: 1}
+    if event_type == "PaymentRequested":
+        return "booking.events", "payment.requested", event, None
+    return None
+
+
+def dlq_reason(properties, event):
+    deaths = (properties.headers or {}).get("x-death") or []
+    if deaths:
+        return deaths[0].get("reason")
+    return event.get("reason")
+
+
+def parse_iso(value):
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class DlqReplayJob:
+    """Drena payments.dlq hacia su cola de origen respetando tasa, filtros e idempotencia.
+
+    Un pago re-inyectado solo se reintenta si su clave payments:processed:* no existe o
+    quedo en "failed"; si luego tuvo exito ("succeeded") el mensaje se descarta. Un claim
+    "processing" se respeta mientras sea mas nuevo que stale_secs (su edad sale del TTL de
+    la clave); mas viejo se da por huerfano de un worker caido y se libera, igual que con
+    force. Lo que no pasa los filtros o no se puede re-inyectar vuelve a la DLQ al terminar.
+    """
+
+    def __init__(
+        self,
+        rate,
+        burst,
+        limit=None,
+        since=None,
+        until=None,
+        reason=None,
+        stale_secs=DLQ_REPLAY_STALE_CLAIM_SECS,
+        force=False,
+    ):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst
+        self.limit = limit
+        self.since = parse_iso(since)
+        self.until = parse_iso(until)
+        self.reason = reason
+        self.stale_secs = stale_secs
+        self.force = force
+        self.state = "pending"
+        self.error = None
+        self.total = 0
+        self.counts = {"replayed": 0, "replayed_stale_claim": 0, "skipped_succeeded": 0, "kept": 0}
+        self.started_at = None
+        self.finished_at = None
+
+    def _matches(self, properties, event):
+        if self.reason and dlq_reason(properties, event) != self.reason:
+            return False
+        if self.since or self.until:
+            ts = parse_iso(event.get("timestamp"))
+            if ts is None:
+                return False
+            if self.since and ts < self.since:
+                return False
+            if self.until and ts > self.until:
+                return False
+        return True
+
+    def _decide(self, properties, event):
+        if not self._matches(properties, event):
+            return "kept", None
+        target = dlq_replay_target(event)
+        reservation_id = event.get("reservationId")
+        if target is None or not reservation_id:
+            return "kept", None
+        key = processed_key(reservation_id)
+        pipe = redis_client().pipeline(transaction=False)
+        pipe.get(key)
+        pipe.ttl(key)
+        with redis_command_seconds.labels(operation="replay_lookup").time():
+            state, ttl = pipe.execute()
+        if state == "succeeded":
+            return "skipped_succeeded", None
+        if state == "failed" or (state == "1" and event.get("eventType") == "PaymentFailed"):
+            redis_client().delete(key)
+        elif state is not None:
+            # Sin TTL (-1) no hay edad: solo force lo libera
+            claim_age = IDEMPOTENCY_TTL_SECS - ttl if ttl >= 0 else None
+            if not self.force and (claim_age is None or claim_age < self.stale_secs):
+                # En proceso en otro worker: no arriesgar un doble cobro
+                return "kept", None
+            app.logger.warning("Replay DLQ libera claim %s de %s (edad %ss)", state, reservation_id, claim_age)
+            redis_client().delete(key)
+            return "replayed_stale_claim", target
+        return "replayed", target
+
+    def _record(self, outcome, processed):
+        self.counts[outcome] += 1
+        dlq_replay_messages_total.labels(outcome=outcome).inc()
+        dlq_replay_remaining.set(max(self.total - processed, 0))
+        elapsed = time.time() - self.started_at
+        if elapsed > 0:
+            dlq_replay_throughput.set(processed / elapsed)
+
+    def run(self):
+        self.state = "running"
+        self.started_at = time.time()
+        connection = rabbit.open_connection()
         try:
-            connection = rabbit_connection()
             channel = connection.channel()
-            setup_topology(channel)
-            channel.basic_qos(prefetch_count=10)
-            channel.basic_consume(queue="payments.validated", on_message_callback=on_payment_validated)
-            channel.basic_consume(queue="payments.monitor", on_message_callback=on_health_ping)
-            app.logger.info("Consumidor RabbitMQ de pagos activo")
-            channel.start_consuming()
+            rabbit.ensure_topology(channel)
+            self.total = channel.queue_declare(queue="payments.dlq", passive=True).method.message_count
+            if self.limit:
+                self.total = min(self.total, self.limit)
+            app.logger.info("Replay DLQ iniciado: %s mensajes a %.1f msg/s", self.total, self.rate)
+
+            bucket = TokenBucket(self.rate, self.burst)
+            kept_tags = []
+            for processed in range(1, self.total + 1):
+                method, properties, body = channel.basic_get(queue="payments.dlq", auto_ack=False)
+                if method is None:
+                    break
+                try:
+                    event = json.loads(body.decode("utf-8"))
+                    outcome, target = self._decide(properties, event)
+                except ValueError:
+                    outcome, target = "kept", None
+
+                if outcome == "kept":
+                    kept_tags.append(method.delivery_tag)
+                else:
+                    if target is not None:
+                        bucket.acquire(sleep=connection.sleep)
+                        # Confirmado antes de sacar el mensaje de la DLQ
+                        rabbit.publish(*target)
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+                self._record(outcome, processed)
+                if processed % 100 == 0:
+                    app.logger.info("Replay DLQ: %s/%s %s", processed, self.total, self.counts)
+
+            for tag in kept_tags:
+                channel.basic_nack(delivery_tag=tag, requeue=True)
+            self.state = "finished"
         except Exception as exc:
-            app.logger.warning("Consumidor pagos reiniciando: %s", exc)
-            time.sleep(2)
+            self.state = "failed"
+            self.error = str(exc)
+            app.logger.warning("Replay DLQ fallo: %s", exc)
+        finally:
+            self.finished_at = time.time()
+            dlq_replay_remaining.set(0)
+            try:
+                connection.close()
+            except Exception:
+                pass
+        app.logger.info("Replay DLQ %s: %s", self.state, self.counts)
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "error": self.error,
+            "total": self.total,
+            "counts": dict(self.counts),
+            "rate": self.rate,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+@app.post("/admin/dlq/replay")
+def start_dlq_replay():
+    global _replay_job
+    data = request.get_json(silent=True) or {}
+    try:
+        job = DlqReplayJob(
+            rate=float(data.get("rate", DLQ_REPLAY_RATE)),
+            burst=int(data.get("burst", DLQ_REPLAY_BURST)),
+            limit=int(data["max"]) if data.get("max") is not None else None,
+            since=data.get("since"),
+            until=data.get("until"),
+            reason=data.get("reason"),
+            stale_secs=int(data.get("staleSecs", DLQ_REPLAY_STALE_CLAIM_SECS)),
+            force=bool(data.get("force", False)),
+        )
+    except (TypeError, ValueError) as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    with _replay_lock:
+        if _replay_job is not None and _replay_job.state in ("pending", "running"):
+            return jsonify({"error": "replay already running", "job": _replay_job.snapshot()}), 409
+        _replay_job = job
+    threading.Thread(target=job.run, daemon=True).start()
+    return jsonify(job.snapshot()), 202
+
+
+@app.get("/admin/dlq/replay")
+def dlq_replay_status():
+    if _replay_job is None:
+        return jsonify({"state": "idle"})
+    return jsonify(_replay_job.snapshot())
 
 
 @app.get("/health")
@@ -256,11 +886,39 @@ def metrics():
 
 def bootstrap():
     redis_client()
-    connect_publish_channel()
-    thread = threading.Thread(target=consumer_worker, daemon=True)
-    thread.start()
+    rabbit.start()
+    for target in (consumer_worker, health_worker):
+        threading.Thread(target=target, daemon=True).start()
+
+
+def replay_dlq_cli(argv):
+    parser = argparse.ArgumentParser(prog="app.py replay-dlq", description="Re-inyecta payments.dlq")
+    parser.add_argument("--rate", type=float, default=DLQ_REPLAY_RATE, help="mensajes por segundo")
+    parser.add_argument("--burst", type=int, default=DLQ_REPLAY_BURST)
+    parser.add_argument("--max", type=int, default=None, help="maximo de mensajes a revisar")
+    parser.add_argument("--since", default=None, help="ISO-8601, timestamp minimo del evento")
+    parser.add_argument("--until", default=None, help="ISO-8601, timestamp maximo del evento")
+    parser.add_argument("--reason", default=None, help="ej. provider_unavailable, expired, maxlen")
+    parser.add_argument(
+        "--stale-secs",
+        type=int,
+        default=DLQ_REPLAY_STALE_CLAIM_SECS,
+        help="edad a partir de la cual un claim processing se considera huerfano",
+    )
+    parser.add_argument("--force", action="store_true", help="re-inyectar aunque haya un claim processing reciente")
+    args = parser.parse_args(argv)
+
+    redis_client()
+    job = DlqReplayJob(
+        args.rate, args.burst, args.max, args.since, args.until, args.reason, args.stale_secs, args.force
+    )
+    job.run()
+    print(json.dumps(job.snapshot(), indent=2))
+    return 0 if job.state == "finished" else 1
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "replay-dlq":
+        sys.exit(replay_dlq_cli(sys.argv[2:]))
     bootstrap()
     app.run(host="0.0.0.0", port=PORT)
@@ -1,14 +1,23 @@
 import json
+import math
 import os
+import queue
 import threading
 import time
 import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
-import pika
 import psycopg2
-from flask import Flask, jsonify, request
-from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, generate_latest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
+from flask import Flask, Response, jsonify, request, stream_with_context
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from common.flask_metrics import instrument_flask
+from common.messaging import RabbitClient, declare_health_queue, health_queue_name
 
 
 APP_NAME = "reservas"
@@ -16,13 +25,52 @@ PORT = int(os.getenv("PORT", "8080"))
 RABBIT_HOST = os.getenv("RABBIT_HOST", "rabbitmq")
 RABBIT_USER = os.getenv("RABBIT_USER", "guest")
 RABBIT_PASS = os.getenv("RABBIT_PASS", "guest")
+RABBIT_PUBLISH_CHANNELS = int(os.getenv("RABBIT_PUBLISH_CHANNELS", "2"))
 PG_HOST = os.getenv("PG_HOST", "postgres")
 PG_PORT = int(os.getenv("PG_PORT", "5432"))
 PG_DB = os.getenv("PG_DB", "d2b")
 PG_USER = os.getenv("PG_USER", "postgres")
 PG_PASS = os.getenv("PG_PASS", "admin")
 
+# Los pings se atienden en un carril propio; la saturacion del consumo de negocio se reporta en el pong
+SATURATION_BUSY_SECS = float(os.getenv("SATURATION_BUSY_SECS", "5.0"))
+
+# Pool de conexiones PostgreSQL compartido por handlers HTTP y consumidor RabbitMQ
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_POOL_TIMEOUT_SECS = float(os.getenv("PG_POOL_TIMEOUT_SECS", "5.0"))
+PG_POOL_CHECK_IDLE_SECS = float(os.getenv("PG_POOL_CHECK_IDLE_SECS", "30.0"))
+
+# Outbox transaccional: el relay drena en lotes hacia RabbitMQ con publisher confirms
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL_SECS = float(os.getenv("OUTBOX_POLL_INTERVAL_SECS", "0.5"))
+RESERVATION_BATCH_MAX = int(os.getenv("RESERVATION_BATCH_MAX", "500"))
+
+# Cache en memoria de GET /reservas/<id>, actualizada desde los eventos de pago
+RESERVATION_CACHE_SIZE = int(os.getenv("RESERVATION_CACHE_SIZE", "10000"))
+RESERVATION_CACHE_TTL_SECS = float(os.getenv("RESERVATION_CACHE_TTL_SECS", "30.0"))
+
+# Long-poll / SSE de cambios de estado. Bajo gunicorn con worker gevent cada espera es un
+# greenlet, no un hilo: STATUS_WAITERS_MAX es solo un tope de seguridad de memoria y sockets
+# (pasado el tope se responde 503 con Retry-After) y debe quedar bajo WORKER_CONNECTIONS
+STATUS_WAIT_MAX_SECS = float(os.getenv("STATUS_WAIT_MAX_SECS", "60.0"))
+STATUS_WAITERS_MAX = int(os.getenv("STATUS_WAITERS_MAX", "20000"))
+STATUS_WAITERS_RETRY_AFTER_SECS = int(os.getenv("STATUS_WAITERS_RETRY_AFTER_SECS", "2"))
+SSE_KEEPALIVE_SECS = float(os.getenv("SSE_KEEPALIVE_SECS", "15.0"))
+TERMINAL_STATUSES = {"CONFIRMED", "PAYMENT_FAILED"}
+
+# Micro-batching del consumidor de eventos de pago (1 = un UPDATE por mensaje)
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "20"))
+PAYMENT_BATCH_SIZE = int(os.getenv("PAYMENT_BATCH_SIZE", "1"))
+PAYMENT_BATCH_MAX_WAIT_MS = int(os.getenv("PAYMENT_BATCH_MAX_WAIT_MS", "50"))
+
+PAYMENT_EVENT_STATUS = {
+    "PaymentSucceeded": "CONFIRMED",
+    "PaymentFailed": "PAYMENT_FAILED",
+}
+
 app = Flask(__name__)
+instrument_flask(app, "reservas")
 
 reservations_created_total = Counter("reservations_created_total", "Reservas creadas")
 payment_events_total = Counter(
@@ -35,16 +83,50 @@ service_heartbeat_total = Counter(
     "Cantidad de pong emitidos por reservas",
 )
 last_event_ts = Gauge("reservas_last_event_unix_seconds", "Ultimo evento procesado por reservas")
+pg_pool_in_use = Gauge("reservas_pg_pool_in_use", "Conexiones PostgreSQL prestadas del pool")
+pg_pool_idle = Gauge("reservas_pg_pool_idle", "Conexiones PostgreSQL libres en el pool")
+pg_pool_wait_seconds = Histogram(
+    "reservas_pg_pool_wait_seconds",
+    "Espera para obtener una conexion del pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+outbox_published_total = Counter("reservas_outbox_published_total", "Eventos publicados desde el outbox")
+outbox_pending = Gauge("reservas_outbox_pending", "Eventos pendientes en el outbox")
+outbox_lag_seconds = Gauge(
+    "reservas_outbox_lag_seconds",
+    "Antiguedad del evento pendiente mas viejo del outbox",
+)
+reservation_cache_hits_total = Counter("reservas_cache_hits_total", "Aciertos de la cache de reservas")
+reservation_cache_misses_total = Counter("reservas_cache_misses_total", "Fallos de la cache de reservas")
+reservation_cache_evictions_total = Counter(
+    "reservas_cache_evictions_total",
+    "Entradas expulsadas de la cache de reservas",
+    ["reason"],
+)
+reservation_cache_size = Gauge("reservas_cache_entries", "Entradas en la cache de reservas")
+status_waiters_gauge = Gauge("reservas_status_waiters", "Clientes esperando cambio de estado (long-poll/SSE)")
+status_waiters_rejected_total = Counter(
+    "reservas_status_waiters_rejected_total",
+    "Esperas rechazadas por superar STATUS_WAITERS_MAX",
+)
+
+db_query_seconds = Histogram(
+    "reservas_db_query_duration_seconds",
+    "Latencia de operaciones PostgreSQL",
+    ["query"],
+)
 
-_rabbit_lock = threading.Lock()
-_rabbit_publish_channel = None
+_outbox_wakeup = threading.Event()
+# Solo lo toca el hilo consumidor: (delivery_tag, reservation_id, event_type)
+_payment_batch = []
+_payment_batch_timer = None
 
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def pg_conn():
+def pg_connect():
     return psycopg2.connect(
         host=PG_HOST,
         port=PG_PORT,
@@ -54,6 +136,202 @@ def pg_conn():
     )
 
 
+class PgPool:
+    """Pool acotado y thread-safe de conexiones psycopg2 (LIFO, con chequeo al prestar)."""
+
+    def __init__(self, minconn, maxconn, timeout, check_idle_secs):
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._timeout = timeout
+        self._check_idle_secs = check_idle_secs
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    def _report(self):
+        pg_pool_in_use.set(self._in_use)
+        pg_pool_idle.set(len(self._idle))
+
+    def fill(self):
+        with self._cond:
+            while len(self._idle) + self._in_use < self._minconn:
+                self._idle.append((pg_connect(), time.time()))
+            self._report()
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.time() - idle_since < self._check_idle_secs:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.time()
+        deadline = start + self._timeout
+        with self._cond:
+            while not self._idle and self._in_use >= self._maxconn:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError("pool PostgreSQL agotado")
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            self._report()
+        pg_pool_wait_seconds.observe(time.time() - start)
+
+        try:
+            if entry is not None:
+                conn, idle_since = entry
+                if self._healthy(conn, idle_since):
+                    return conn
+                app.logger.warning("Conexion PostgreSQL del pool descartada por chequeo fallido")
+                conn.close()
+            return pg_connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._report()
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            conn.close()
+        with self._cond:
+            self._in_use -= 1
+            if not discard and not conn.closed:
+                self._idle.append((conn, time.time()))
+            self._report()
+            self._cond.notify()
+
+
+_pg_pool = PgPool(PG_POOL_MIN, PG_POOL_MAX, PG_POOL_TIMEOUT_SECS, PG_POOL_CHECK_IDLE_SECS)
+
+
+@contextmanager
+def pg_conn():
+    conn = _pg_pool.getconn()
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        _pg_pool.putconn(conn, discard=discard)
+
+
+class ReservationCache:
+    """LRU con TTL de respuestas JSON de GET /reservas/<id>."""
+
+    def __init__(self, max_size, ttl_secs):
+        self._max_size = max_size
+        self._ttl_secs = ttl_secs
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, reservation_id):
+        with self._lock:
+            entry = self._entries.get(reservation_id)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[reservation_id]
+                reservation_cache_evictions_total.labels(reason="expired").inc()
+                reservation_cache_size.set(len(self._entries))
+                entry = None
+            if entry is None:
+                reservation_cache_misses_total.inc()
+                return None
+            self._entries.move_to_end(reservation_id)
+            reservation_cache_hits_total.inc()
+            return entry[0]
+
+    def put(self, reservation_id, body, only_if_absent=False):
+        now = time.time()
+        with self._lock:
+            # Las lecturas no pisan un valor mas nuevo escrito por el consumidor
+            current = self._entries.get(reservation_id)
+            if only_if_absent and current is not None and current[1] > now:
+                return
+            self._entries[reservation_id] = (body, now + self._ttl_secs)
+            self._entries.move_to_end(reservation_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                reservation_cache_evictions_total.labels(reason="capacity").inc()
+            reservation_cache_size.set(len(self._entries))
+
+
+_reservation_cache = ReservationCache(RESERVATION_CACHE_SIZE, RESERVATION_CACHE_TTL_SECS)
+
+
+class StatusWaiters:
+    """Registro de esperas por reserva; lo alimenta el consumidor de eventos de pago.
+
+    Cada espera es una cola propia: notificar cuesta O(esperas de esa reserva) y no
+    se crea ningun hilo adicional por espera.
+    """
+
+    def __init__(self, max_waiters):
+        self._max_waiters = max_waiters
+        self._waiters = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, reservation_id):
+        waiter = queue.SimpleQueue()
+        with self._lock:
+            if self._count >= self._max_waiters:
+                status_waiters_rejected_total.inc()
+                return None
+            self._waiters.setdefault(reservation_id, []).append(waiter)
+            self._count += 1
+            status_waiters_gauge.set(self._count)
+        return waiter
+
+    def unsubscribe(self, reservation_id, waiter):
+        with self._lock:
+            waiters = self._waiters.get(reservation_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+                self._count -= 1
+                if not waiters:
+                    del self._waiters[reservation_id]
+            status_waiters_gauge.set(self._count)
+
+    def notify(self, reservation_id, body):
+        with self._lock:
+            waiters = list(self._waiters.get(reservation_id, ()))
+        for waiter in waiters:
+            waiter.put(body)
+
+
+_status_waiters = StatusWaiters(STATUS_WAITERS_MAX)
+
+
+def reservation_body(row):
+    return json.dumps(
+        {
+            "reservationId": row[0],
+            "userId": row[1],
+            "amount": row[2],
+            "status": row[3],
+            "createdAt": row[4].isoformat(),
+            "updatedAt": row[5].isoformat(),
+        }
+    )
+
+
 def init_db():
     with pg_conn() as conn:
         with conn.cursor() as cur:
@@ -67,17 +345,18 @@ def init_db():
                     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
                     updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
                 );
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id BIGSERIAL PRIMARY KEY,
+                    exchange TEXT NOT NULL,
+                    routing_key TEXT NOT NULL,
+                    payload JSONB NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
                 """
             )
         conn.commit()
 
 
-def rabbit_connection():
-    credentials = pika.PlainCredentials(RABBIT_USER, RABBIT_PASS)
-    params = pika.ConnectionParameters(host=RABBIT_HOST, credentials=credentials, heartbeat=30)
-    return pika.BlockingConnection(params)
-
-
 def setup_topology(channel):
     channel.exchange_declare(exchange="booking.events", exchange_type="topic", durable=True)
     channel.exchange_declare(exchange="payments.events", exchange_type="topic", durable=True)
@@ -91,106 +370,222 @@ def setup_topology(channel):
         routing_key="payment.*",
     )
 
-    channel.queue_declare(queue="reservas.monitor", durable=True)
-    channel.queue_bind(
-        exchange="control.ping",
-        queue="reservas.monitor",
-        routing_key="health.ping",
+    declare_health_queue(channel, "reservas.monitor")
+
+
+rabbit = RabbitClient(
+    APP_NAME,
+    "reservas",
+    setup_topology,
+    RABBIT_HOST,
+    RABBIT_USER,
+    RABBIT_PASS,
+    publish_channels=RABBIT_PUBLISH_CHANNELS,
+    logger=app.logger,
+)
+
+
+def enqueue_outbox(cur, entries):
+    execute_values(
+        cur,
+        "INSERT INTO outbox (exchange, routing_key, payload) VALUES %s",
+        [(exchange, routing_key, json.dumps(payload)) for exchange, routing_key, payload in entries],
+        template="(%s, %s, %s::jsonb)",
+        page_size=max(len(entries), 1),
     )
 
 
-def connect_publish_channel():
-    global _rabbit_publish_channel
-    while _rabbit_publish_channel is None:
-        try:
-            connection = rabbit_connection()
-            channel = connection.channel()
-            setup_topology(channel)
-            _rabbit_publish_channel = channel
-            app.logger.info("Canal RabbitMQ de publicacion listo en reservas")
-        except Exception as exc:
-            app.logger.warning("Esperando RabbitMQ para publicar: %s", exc)
-            time.sleep(2)
+def payment_requested_event(reservation_id, user_id, amount):
+    return {
+        "eventType": "PaymentRequested",
+        "reservationId": reservation_id,
+        "userId": user_id,
+        "amount": amount,
+        "correlationId": reservation_id,
+        "timestamp": now_iso(),
+    }
 
 
-def publish(exchange, routing_key, payload):
-    with _rabbit_lock:
-        if _rabbit_publish_channel is None:
-            connect_publish_channel()
-        body = json.dumps(payload).encode("utf-8")
-        _rabbit_publish_channel.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
-            body=body,
-            properties=pika.BasicProperties(
-                content_type="application/json",
-                delivery_mode=2,
-            ),
-        )
+def insert_reservations(rows):
+    """Inserta reservas (reservation_id, user_id, amount) y sus PaymentRequested en una transaccion."""
+    with db_query_seconds.labels(query="insert_reservations").time(), pg_conn() as conn:
+        with conn.cursor() as cur:
+            inserted = execute_values(
+                cur,
+                """
+                INSERT INTO reservations (reservation_id, user_id, amount, status) VALUES %s
+                RETURNING reservation_id, user_id, amount::text, status, created_at, updated_at
+                """,
+                [(reservation_id, user_id, amount, "PENDING_PAYMENT") for reservation_id, user_id, amount in rows],
+                page_size=len(rows),
+                fetch=True,
+            )
+            enqueue_outbox(
+                cur,
+                [
+                    ("booking.events", "payment.requested", payment_requested_event(*row))
+                    for row in rows
+                ],
+            )
+        conn.commit()
 
+    for row in inserted:
+        _reservation_cache.put(row[0], reservation_body(row))
+    _outbox_wakeup.set()
+    reservations_created_total.inc(len(rows))
+    last_event_ts.set(time.time())
 
-def update_reservation_status(reservation_id: str, new_status: str):
-    with pg_conn() as conn:
+
+def relay_outbox_batch():
+    with db_query_seconds.labels(query="relay_outbox").time(), pg_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                UPDATE reservations
-                SET status = %s, updated_at = NOW()
-                WHERE reservation_id = %s
+                SELECT id, exchange, routing_key, payload::text
+                FROM outbox
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
                 """,
-                (new_status, reservation_id),
+                (OUTBOX_BATCH_SIZE,),
+            )
+            rows = cur.fetchall()
+            # publish_many lanza excepcion si el broker no confirma el lote:
+            # la transaccion hace rollback y el lote se reintenta (at-least-once).
+            rabbit.publish_many(
+                [(exchange, routing_key, payload.encode("utf-8")) for _id, exchange, routing_key, payload in rows]
             )
+            if rows:
+                cur.execute("DELETE FROM outbox WHERE id = ANY(%s)", ([row[0] for row in rows],))
+            cur.execute("SELECT COUNT(*), EXTRACT(EPOCH FROM NOW() - MIN(created_at)) FROM outbox")
+            pending, lag = cur.fetchone()
         conn.commit()
 
+    outbox_published_total.inc(len(rows))
+    outbox_pending.set(pending)
+    outbox_lag_seconds.set(float(lag or 0.0))
+    return len(rows)
+
+
+def outbox_relay_worker():
+    app.logger.info("Relay de outbox activo en reservas")
+    while True:
+        try:
+            _outbox_wakeup.clear()
+            if relay_outbox_batch() < OUTBOX_BATCH_SIZE:
+                _outbox_wakeup.wait(OUTBOX_POLL_INTERVAL_SECS)
+        except Exception as exc:
+            app.logger.warning("Relay outbox reintentando: %s", exc)
+            time.sleep(2)
+
+
+def update_reservation_statuses(updates):
+    with db_query_seconds.labels(query="update_statuses").time(), pg_conn() as conn:
+        with conn.cursor() as cur:
+            updated = execute_values(
+                cur,
+                """
+                UPDATE reservations AS r
+                SET status = v.status, updated_at = NOW()
+                FROM (VALUES %s) AS v(reservation_id, status)
+                WHERE r.reservation_id = v.reservation_id
+                RETURNING r.reservation_id, r.user_id, r.amount::text, r.status, r.created_at, r.updated_at
+                """,
+                updates,
+                page_size=len(updates),
+                fetch=True,
+            )
+        conn.commit()
+
+    for row in updated:
+        body = reservation_body(row)
+        _reservation_cache.put(row[0], body)
+        _status_waiters.notify(row[0], body)
+
+
+def update_reservation_status(reservation_id: str, new_status: str):
+    update_reservation_statuses([(reservation_id, new_status)])
+
+
+def flush_payment_batch(ch, from_timer=False):
+    global _payment_batch, _payment_batch_timer
+    if _payment_batch_timer is not None and not from_timer:
+        ch.connection.remove_timeout(_payment_batch_timer)
+    _payment_batch_timer = None
+    batch, _payment_batch = _payment_batch, []
+    if not batch:
+        return
+
+    # El ultimo evento por reserva gana, igual que aplicandolos en orden
+    statuses = {}
+    for _tag, reservation_id, event_type in batch:
+        statuses[reservation_id] = PAYMENT_EVENT_STATUS[event_type]
+    last_tag = batch[-1][0]
+    try:
+        update_reservation_statuses(list(statuses.items()))
+    except Exception as exc:
+        # Sin ack: el lote vuelve a la cola (at-least-once)
+        app.logger.warning("Lote de %s eventos de pago no aplicado: %s", len(batch), exc)
+        rabbit.nack(ch, last_tag, multiple=True)
+        return
+
+    rabbit.ack(ch, last_tag, multiple=True)
+    for _tag, _reservation_id, event_type in batch:
+        payment_events_total.labels(event_type=event_type).inc()
+    last_event_ts.set(time.time())
+
 
 def on_payment_event(ch, _method, _properties, body):
+    global _payment_batch_timer
+    deferred = False
     try:
         event = json.loads(body.decode("utf-8"))
         event_type = event.get("eventType", "unknown")
         reservation_id = event.get("reservationId")
-        if not reservation_id:
-            ch.basic_ack(delivery_tag=_method.delivery_tag)
+        new_status = PAYMENT_EVENT_STATUS.get(event_type)
+        if not reservation_id or new_status is None:
             return
-        if event_type == "PaymentSucceeded":
-            update_reservation_status(reservation_id, "CONFIRMED")
-            payment_events_total.labels(event_type="PaymentSucceeded").inc()
-        elif event_type == "PaymentFailed":
-            update_reservation_status(reservation_id, "PAYMENT_FAILED")
-            payment_events_total.labels(event_type="PaymentFailed").inc()
+
+        if PAYMENT_BATCH_SIZE > 1:
+            # El ack queda diferido hasta que el lote se confirme en PostgreSQL
+            _payment_batch.append((_method.delivery_tag, reservation_id, event_type))
+            deferred = True
+            if len(_payment_batch) >= PAYMENT_BATCH_SIZE:
+                flush_payment_batch(ch)
+            elif _payment_batch_timer is None:
+                _payment_batch_timer = ch.connection.call_later(
+                    PAYMENT_BATCH_MAX_WAIT_MS / 1000.0,
+                    lambda: flush_payment_batch(ch, from_timer=True),
+                )
+            return
+
+        update_reservation_status(reservation_id, new_status)
+        payment_events_total.labels(event_type=event_type).inc()
         last_event_ts.set(time.time())
     finally:
-        ch.basic_ack(delivery_tag=_method.delivery_tag)
+        if not deferred:
+            rabbit.ack(ch, _method.delivery_tag)
 
 
-def on_health_ping(ch, _method, _properties, body):
-    try:
-        ping = json.loads(body.decode("utf-8"))
-        payload = {
-            "eventType": "HealthPong",
-            "service": APP_NAME,
-            "pingId": ping.get("pingId"),
-            "timestamp": now_iso(),
-        }
-        publish("control.pong", "health.pong", payload)
-        service_heartbeat_total.inc()
-    finally:
-        ch.basic_ack(delivery_tag=_method.delivery_tag)
+def reset_payment_batch(_channel):
+    global _payment_batch, _payment_batch_timer
+    # Lo pendiente de un canal caido lo reentrega RabbitMQ
+    _payment_batch = []
+    _payment_batch_timer = None
 
 
 def consumer_worker():
-    while True:
-        try:
-            connection = rabbit_connection()
-            channel = connection.channel()
-            setup_topology(channel)
-            channel.basic_qos(prefetch_count=20)
-            channel.basic_consume(queue="reservas.payments", on_message_callback=on_payment_event)
-            channel.basic_consume(queue="reservas.monitor", on_message_callback=on_health_ping)
-            app.logger.info("Consumidor RabbitMQ de reservas activo")
-            channel.start_consuming()
-        except Exception as exc:
-            app.logger.warning("Consumidor reservas reiniciando: %s", exc)
-            time.sleep(2)
+    rabbit.consume(
+        {"reservas.payments": on_payment_event},
+        CONSUMER_PREFETCH,
+        on_connect=reset_payment_batch,
+    )
+
+
+def health_worker():
+    rabbit.consume_health(
+        health_queue_name("reservas.monitor"), SATURATION_BUSY_SECS, on_pong=service_heartbeat_total.inc
+    )
 
 
 @app.post("/reservas")
@@ -200,28 +595,8 @@ def create_reservation():
     amount = float(data.get("amount", 100.0))
     reservation_id = str(uuid.uuid4())
 
-    with pg_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO reservations (reservation_id, user_id, amount, status)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (reservation_id, user_id, amount, "PENDING_PAYMENT"),
-            )
-        conn.commit()
-
-    event = {
-        "eventType": "PaymentRequested",
-        "reservationId": reservation_id,
-        "userId": user_id,
-        "amount": amount,
-        "correlationId": reservation_id,
-        "timestamp": now_iso(),
-    }
-    publish("booking.events", "payment.requested", event)
-    reservations_created_total.inc()
-    last_event_ts.set(time.time())
+    # Reserva y evento en la misma transaccion; el relay publica PaymentRequested
+    insert_reservations([(reservation_id, user_id, amount)])
 
     return (
         jsonify(
@@ -235,9 +610,45 @@ def create_reservation():
     )
 
 
-@app.get("/reservas/<reservation_id>")
-def get_reservation(reservation_id):
-    with pg_conn() as conn:
+@app.post("/reservas/batch")
+def create_reservations_batch():
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get("reservations")
+    if not isinstance(data, list) or not data or not all(isinstance(item, dict) for item in data):
+        return jsonify({"error": "expected a non-empty array of reservations"}), 400
+    if len(data) > RESERVATION_BATCH_MAX:
+        return jsonify({"error": f"batch exceeds {RESERVATION_BATCH_MAX} reservations"}), 400
+
+    rows = []
+    for idx, item in enumerate(data):
+        try:
+            amount = float(item.get("amount", 100.0))
+        except (TypeError, ValueError):
+            amount = None
+        if amount is None or not math.isfinite(amount):
+            return jsonify({"error": f"reservations[{idx}].amount must be a number"}), 400
+        rows.append((str(uuid.uuid4()), item.get("userId", "anon"), amount))
+    insert_reservations(rows)
+
+    return (
+        jsonify(
+            {
+                "reservationIds": [row[0] for row in rows],
+                "status": "PENDING_PAYMENT",
+                "count": len(rows),
+            }
+        ),
+        202,
+    )
+
+
+def load_reservation_body(reservation_id):
+    body = _reservation_cache.get(reservation_id)
+    if body is not None:
+        return body
+
+    with db_query_seconds.labels(query="select_reservation").time(), pg_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -249,16 +660,89 @@ def get_reservation(reservation_id):
             )
             row = cur.fetchone()
     if not row:
+        return None
+    body = reservation_body(row)
+    _reservation_cache.put(reservation_id, body, only_if_absent=True)
+    return body
+
+
+def too_many_waiters():
+    # El cliente puede reintentar la espera o caer a GET /reservas/<id>
+    response = jsonify({"error": "too many waiters"})
+    response.headers["Retry-After"] = str(STATUS_WAITERS_RETRY_AFTER_SECS)
+    return response, 503
+
+
+def wait_timeout_arg():
+    try:
+        timeout = float(request.args.get("timeout", STATUS_WAIT_MAX_SECS))
+    except ValueError:
+        timeout = STATUS_WAIT_MAX_SECS
+    return min(max(timeout, 0.0), STATUS_WAIT_MAX_SECS)
+
+
+@app.get("/reservas/<reservation_id>")
+def get_reservation(reservation_id):
+    body = load_reservation_body(reservation_id)
+    if body is None:
         return jsonify({"error": "reservation not found"}), 404
-    return jsonify(
-        {
-            "reservationId": row[0],
-            "userId": row[1],
-            "amount": row[2],
-            "status": row[3],
-            "createdAt": row[4].isoformat(),
-            "updatedAt": row[5].isoformat(),
-        }
+    return app.response_class(body, mimetype="application/json")
+
+
+@app.get("/reservas/<reservation_id>/wait")
+def wait_reservation(reservation_id):
+    timeout = wait_timeout_arg()
+    # Suscribir antes de leer el estado para no perder un evento intermedio
+    waiter = _status_waiters.subscribe(reservation_id)
+    if waiter is None:
+        return too_many_waiters()
+    try:
+        body = load_reservation_body(reservation_id)
+        if body is None:
+            return jsonify({"error": "reservation not found"}), 404
+        if json.loads(body)["status"] in TERMINAL_STATUSES:
+            return app.response_class(body, mimetype="application/json")
+        try:
+            body = waiter.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        return app.response_class(body, mimetype="application/json")
+    finally:
+        _status_waiters.unsubscribe(reservation_id, waiter)
+
+
+@app.get("/reservas/<reservation_id>/events")
+def stream_reservation(reservation_id):
+    timeout = wait_timeout_arg()
+    waiter = _status_waiters.subscribe(reservation_id)
+    if waiter is None:
+        return too_many_waiters()
+    body = load_reservation_body(reservation_id)
+    if body is None:
+        _status_waiters.unsubscribe(reservation_id, waiter)
+        return jsonify({"error": "reservation not found"}), 404
+
+    def events(body):
+        try:
+            deadline = time.time() + timeout
+            yield f"event: status\ndata: {body}\n\n"
+            while json.loads(body)["status"] not in TERMINAL_STATUSES:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    body = waiter.get(timeout=min(remaining, SSE_KEEPALIVE_SECS))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: status\ndata: {body}\n\n"
+        finally:
+            _status_waiters.unsubscribe(reservation_id, waiter)
+
+    return Response(
+        stream_with_context(events(body)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
 
 
@@ -276,14 +760,20 @@ def bootstrap():
     while True:
         try:
             init_db()
+            _pg_pool.fill()
             break
         except Exception as exc:
             app.logger.warning("Esperando PostgreSQL: %s", exc)
             time.sleep(2)
 
-    connect_publish_channel()
-    thread = threading.Thread(target=consumer_worker, daemon=True)
-    thread.start()
+    rabbit.start()
+    threads = [
+        threading.Thread(target=consumer_worker, daemon=True),
+        threading.Thread(target=health_worker, daemon=True),
+        threading.Thread(target=outbox_relay_worker, daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
 
 
 if __name__ == "__main__":
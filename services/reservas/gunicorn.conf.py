@@ -0,0 +1,29 @@
+import os
+import threading
+
+# Un solo proceso con worker gevent: las esperas de long-poll/SSE son greenlets, no hilos, y
+# el registro de esperas, la cache y los consumidores RabbitMQ viven en ese proceso (con
+# varios procesos un evento de pago solo despertaria a las esperas del que lo consumio)
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = 1
+worker_class = "gevent"
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "25000"))
+# Con gevent el timeout vigila que el worker siga vivo, no la duracion de cada request: las
+# esperas de hasta STATUS_WAIT_MAX_SECS no lo disparan
+timeout = 30
+graceful_timeout = 10
+accesslog = None
+
+
+def post_worker_init(worker):
+    # gevent ya parcheo sockets, threading y queue; psycopg2 es C y necesita su propio hook
+    # para ceder el hub mientras espera a PostgreSQL
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+
+    from app import bootstrap
+
+    # En un greenlet aparte: bootstrap espera a PostgreSQL y el arbiter mata al worker que no
+    # reporta vida dentro de timeout
+    threading.Thread(target=bootstrap, daemon=True).start()
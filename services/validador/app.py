@@ -1,12 +1,18 @@
+import importlib
 import json
 import os
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 
-import pika
+import redis
 from flask import Flask, jsonify
-from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from common.flask_metrics import instrument_flask
+from common.messaging import RabbitClient, declare_health_queue, health_queue_name
 
 
 APP_NAME = "validador"
@@ -14,6 +20,19 @@ PORT = int(os.getenv("PORT", "8080"))
 RABBIT_HOST = os.getenv("RABBIT_HOST", "rabbitmq")
 RABBIT_USER = os.getenv("RABBIT_USER", "guest")
 RABBIT_PASS = os.getenv("RABBIT_PASS", "guest")
+RABBIT_PUBLISH_CHANNELS = int(os.getenv("RABBIT_PUBLISH_CHANNELS", "2"))
+REDIS_HOST = os.getenv("REDIS_HOST", "redis-server")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_PASS = os.getenv("REDIS_PASS", "admin")
+
+# Los pings se atienden en un carril propio; la saturacion del consumo de negocio se reporta en el pong
+SATURATION_BUSY_SECS = float(os.getenv("SATURATION_BUSY_SECS", "5.0"))
+
+# Calculadoras retiradas compartidas entre replicas: set en Redis + pub/sub de cambios
+SHARED_RETIRED_STATE = os.getenv("SHARED_RETIRED_STATE", "1") == "1"
+RETIRED_KEY = "validator:retired_calculators"
+RETIRED_CHANNEL = "validator:retired_calculators:changes"
+RETIRED_RESYNC_SECS = float(os.getenv("RETIRED_RESYNC_SECS", "5.0"))
 
 FAULTY_CALCULATOR = os.getenv("FAULTY_CALCULATOR", "calc_c")
 FAULTY_DELTA = float(os.getenv("FAULTY_DELTA", "5.0"))
@@ -22,11 +41,31 @@ FAULTY_DELTA = float(os.getenv("FAULTY_DELTA", "5.0"))
 QUEUE_TTL_MS = int(os.getenv("QUEUE_TTL_MS", "30000"))  # 30s
 QUEUE_MAX_LEN = int(os.getenv("QUEUE_MAX_LEN", "10000"))
 
+# Votacion por lotes: una ventana de prefetch se vota de una vez (1 = mensaje a mensaje)
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "20"))
+VALIDATION_BATCH_SIZE = int(os.getenv("VALIDATION_BATCH_SIZE", "1"))
+VALIDATION_BATCH_MAX_WAIT_MS = int(os.getenv("VALIDATION_BATCH_MAX_WAIT_MS", "20"))
+
+# Calculadoras N-version: nombres habilitados, modulos plugin y ejecucion en paralelo con deadline
+CALCULATORS = [c.strip() for c in os.getenv("CALCULATORS", "calc_a,calc_b,calc_c").split(",") if c.strip()]
+CALCULATOR_PLUGINS = [m.strip() for m in os.getenv("CALCULATOR_PLUGINS", "").split(",") if m.strip()]
+CALCULATOR_PARALLEL = os.getenv("CALCULATOR_PARALLEL", "1") == "1"
+CALCULATOR_TIMEOUT_MS = int(os.getenv("CALCULATOR_TIMEOUT_MS", "500"))
+
+# Memo de votos por (calculadoras activas, monto); 0 = desactivado
+VOTE_CACHE_SIZE = int(os.getenv("VOTE_CACHE_SIZE", "10000"))
+
 app = Flask(__name__)
+instrument_flask(app, "validator")
 
 validation_requests_total = Counter("validator_requests_total", "Validaciones procesadas")
 validation_ok_total = Counter("validator_ok_total", "Validaciones sin divergencia")
 validation_divergence_total = Counter("validator_divergence_total", "Divergencias detectadas")
+validation_no_quorum_total = Counter(
+    "validator_no_quorum_total",
+    "Validaciones sin mayoria estricta, enviadas a payments.dlq",
+    ["reason"],
+)
 validator_heartbeat_total = Counter("validator_heartbeat_total", "Pong emitidos por validador")
 retired_calculators_total = Counter(
     "validator_retired_calculators_total",
@@ -34,22 +73,46 @@ retired_calculators_total = Counter(
     ["calculator"],
 )
 active_calculators_gauge = Gauge("validator_active_calculators", "Cantidad de calculadoras activas")
+calculator_missed_total = Counter(
+    "validator_calculator_missed_total",
+    "Calculadoras sin resultado a tiempo (cuentan como voto disidente)",
+    ["calculator", "reason"],
+)
+calculator_seconds = Histogram(
+    "validator_calculator_duration_seconds",
+    "Latencia de cada calculadora por lote",
+    ["calculator"],
+)
+vote_cache_hits_total = Counter("validator_vote_cache_hits_total", "Votos servidos desde la cache")
+vote_cache_misses_total = Counter("validator_vote_cache_misses_total", "Votos calculados (fallo de cache)")
+vote_cache_evictions_total = Counter(
+    "validator_vote_cache_evictions_total",
+    "Entradas expulsadas de la cache de votos",
+    ["reason"],
+)
+vote_cache_size = Gauge("validator_vote_cache_entries", "Entradas en la cache de votos")
+
 
-_publish_lock = threading.Lock()
-_publish_channel = None
+# Vista local de las retiradas; la votacion no lee Redis
 _retired_calculators = set()
+_retired_lock = threading.Lock()
+_redis = None
+# Holgura para calculadoras que siguen corriendo despues de perder el deadline
+# Un hilo por calculadora: una que se cuelga no le quita hilos a las demas. Mientras su
+# llamada anterior siga corriendo no se le manda otra (cuenta como voto faltante, "busy")
+_calculator_executors = {
+    name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"calculator-{name}") for name in CALCULATORS
+}
+_calculator_running = {}
+# Solo lo toca el hilo consumidor: (delivery_tag, event)
+_validation_batch = []
+_validation_batch_timer = None
 
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def rabbit_connection():
-    credentials = pika.PlainCredentials(RABBIT_USER, RABBIT_PASS)
-    params = pika.ConnectionParameters(host=RABBIT_HOST, credentials=credentials, heartbeat=30)
-    return pika.BlockingConnection(params)
-
-
 def setup_topology(channel):
     channel.exchange_declare(exchange="booking.events", exchange_type="topic", durable=True)
     channel.exchange_declare(exchange="payments.events", exchange_type="topic", durable=True)
@@ -78,176 +141,519 @@ def setup_topology(channel):
         routing_key="payment.requested",
     )
 
-    channel.queue_declare(queue="validator.monitor", durable=True)
-    channel.queue_bind(
-        exchange="control.ping",
-        queue="validator.monitor",
-        routing_key="health.ping",
-    )
+    declare_health_queue(channel, "validator.monitor")
+
+
+rabbit = RabbitClient(
+    APP_NAME,
+    "validator",
+    setup_topology,
+    RABBIT_HOST,
+    RABBIT_USER,
+    RABBIT_PASS,
+    publish_channels=RABBIT_PUBLISH_CHANNELS,
+    logger=app.logger,
+)
 
 
-def connect_publish_channel():
-    global _publish_channel
-    while _publish_channel is None:
+class VoteCache:
+    """LRU acotada de votos unanimes por (calculadoras activas, monto)."""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                vote_cache_misses_total.inc()
+                return None
+            self._entries.move_to_end(key)
+        vote_cache_hits_total.inc()
+        return entry
+
+    def put(self, key, vote):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = vote
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                vote_cache_evictions_total.labels(reason="capacity").inc()
+            vote_cache_size.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            evicted = len(self._entries)
+            self._entries.clear()
+        vote_cache_evictions_total.labels(reason="invalidated").inc(evicted)
+        vote_cache_size.set(0)
+
+
+_vote_cache = VoteCache(VOTE_CACHE_SIZE)
+
+
+def redis_client():
+    global _redis
+    while _redis is None:
         try:
-            connection = rabbit_connection()
-            channel = connection.channel()
-            setup_topology(channel)
-            _publish_channel = channel
-            app.logger.info("Canal RabbitMQ de publicacion listo en validador")
+            _redis = redis.Redis(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                password=REDIS_PASS,
+                decode_responses=True,
+                socket_timeout=2,
+            )
+            _redis.ping()
+            app.logger.info("Redis listo en validador")
         except Exception as exc:
-            app.logger.warning("Esperando RabbitMQ para publicar (validador): %s", exc)
+            app.logger.warning("Esperando Redis: %s", exc)
+            _redis = None
             time.sleep(2)
+    return _redis
 
 
-def publish(exchange, routing_key, payload):
-    with _publish_lock:
-        if _publish_channel is None:
-            connect_publish_channel()
-        _publish_channel.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
-            body=json.dumps(payload).encode("utf-8"),
-            properties=pika.BasicProperties(content_type="application/json", delivery_mode=2),
-        )
+def retired_calculators():
+    with _retired_lock:
+        return set(_retired_calculators)
 
 
-def calculator_result(calc_name: str, amount: float) -> float:
-    if calc_name == FAULTY_CALCULATOR:
-        return round(amount + FAULTY_DELTA, 2)
-    return round(amount, 2)
+def set_retired_view(retired):
+    retired = set(retired)
+    with _retired_lock:
+        changed = retired != _retired_calculators
+        _retired_calculators.clear()
+        _retired_calculators.update(retired)
+    if changed:
+        _vote_cache.clear()
+    active_calculators_gauge.set(len(active_calculators()))
 
 
-def execute_voting(amount: float):
-    available = [c for c in ["calc_a", "calc_b", "calc_c"] if c not in _retired_calculators]
-    if len(available) < 2:
-        # Fallback de seguridad: si se retiraron 2 calculadoras, vuelve a habilitarlas.
-        _retired_calculators.clear()
-        available = ["calc_a", "calc_b", "calc_c"]
-
-    results = {calc: calculator_result(calc, amount) for calc in available}
-    grouped = {}
-    for calc, value in results.items():
-        grouped.setdefault(value, []).append(calc)
-
-    majority_value = max(grouped, key=lambda value: len(grouped[value]))
-    majority_group = grouped[majority_value]
-
-    divergence = len(grouped) > 1
-    retired_now = []
-    if divergence:
-        for value, calculators in grouped.items():
-            if value != majority_value:
-                for calc in calculators:
-                    if calc not in _retired_calculators:
-                        _retired_calculators.add(calc)
-                        retired_calculators_total.labels(calculator=calc).inc()
-                        retired_now.append(calc)
-
-    active_calculators_gauge.set(len([c for c in ["calc_a", "calc_b", "calc_c"] if c not in _retired_calculators]))
-    return {
-        "results": results,
-        "majorityValue": majority_value,
-        "majorityGroup": majority_group,
-        "divergence": divergence,
-        "retiredNow": retired_now,
-        "activeCalculators": [c for c in ["calc_a", "calc_b", "calc_c"] if c not in _retired_calculators],
-    }
+def sync_retired_view():
+    set_retired_view(redis_client().smembers(RETIRED_KEY))
 
 
-def on_validation_requested(ch, method, _properties, body):
+def retire_calculator(calc: str) -> bool:
+    with _retired_lock:
+        if calc in _retired_calculators:
+            return False
+        _retired_calculators.add(calc)
+    _vote_cache.clear()
+    if not SHARED_RETIRED_STATE:
+        return True
     try:
-        event = json.loads(body.decode("utf-8"))
-        reservation_id = event.get("reservationId")
-        original_amount = float(event.get("amount", 0.0))
-        correlation_id = event.get("correlationId", reservation_id)
-        validation_requests_total.inc()
+        pipe = redis_client().pipeline()
+        pipe.sadd(RETIRED_KEY, calc)
+        pipe.publish(RETIRED_CHANNEL, f"retire:{calc}")
+        pipe.execute()
+    except redis.RedisError as exc:
+        app.logger.warning("No se pudo compartir el retiro de %s: %s", calc, exc)
+    return True
+
+
+def reinstate_calculators():
+    set_retired_view(())
+    if not SHARED_RETIRED_STATE:
+        return
+    try:
+        pipe = redis_client().pipeline()
+        pipe.delete(RETIRED_KEY)
+        pipe.publish(RETIRED_CHANNEL, "reset")
+        pipe.execute()
+    except redis.RedisError as exc:
+        app.logger.warning("No se pudo compartir la rehabilitacion de calculadoras: %s", exc)
 
-        vote = execute_voting(original_amount)
 
-        # 1) Evento que habilita el cobro real (pagos consume ESTE)
-        publish(
-            "booking.events",
-            "payment.validated",
+def retired_sync_worker():
+    # Cada aviso recarga el set completo; sin avisos, resync cada RETIRED_RESYNC_SECS
+    while True:
+        try:
+            pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(RETIRED_CHANNEL)
+            sync_retired_view()
+            app.logger.info("Sincronizacion de calculadoras retiradas activa")
+            while True:
+                pubsub.get_message(timeout=RETIRED_RESYNC_SECS)
+                sync_retired_view()
+        except Exception as exc:
+            app.logger.warning("Sincronizacion de calculadoras reiniciando: %s", exc)
+            time.sleep(2)
+
+
+CALCULATOR_REGISTRY = {}
+
+
+def register_calculator(name: str, fn):
+    """Registra fn(amounts) -> lista de resultados en el mismo orden."""
+    CALCULATOR_REGISTRY[name] = fn
+
+
+def builtin_calculator(name: str):
+    delta = FAULTY_DELTA if name == FAULTY_CALCULATOR else 0.0
+
+    def calculate(amounts):
+        return [round(amount + delta, 2) for amount in amounts]
+
+    return calculate
+
+
+def load_calculators():
+    # Un plugin es un modulo con register(register_calculator)
+    for module_name in CALCULATOR_PLUGINS:
+        importlib.import_module(module_name).register(register_calculator)
+    # Lo que no aporte un plugin usa la implementacion de referencia
+    for name in CALCULATORS:
+        if name not in CALCULATOR_REGISTRY:
+            register_calculator(name, builtin_calculator(name))
+
+
+def timed_calculator(name: str, amounts):
+    with calculator_seconds.labels(calculator=name).time():
+        return CALCULATOR_REGISTRY[name](amounts)
+
+
+def evaluate_calculators(names, amounts):
+    """Columna de resultados por calculadora; None si fallo, no termino dentro del deadline o
+    su llamada anterior sigue en curso. Solo la llama el hilo consumidor.
+    """
+    if not CALCULATOR_PARALLEL:
+        return {name: timed_calculator(name, amounts) for name in names}
+
+    columns = {}
+    futures = {}
+    for name in names:
+        running = _calculator_running.get(name)
+        if running is not None and not running.done():
+            calculator_missed_total.labels(calculator=name, reason="busy").inc()
+            columns[name] = None
+            continue
+        futures[name] = _calculator_running[name] = _calculator_executors[name].submit(timed_calculator, name, amounts)
+    done, _pending = wait(futures.values(), timeout=CALCULATOR_TIMEOUT_MS / 1000.0)
+    for name, future in futures.items():
+        if future not in done:
+            calculator_missed_total.labels(calculator=name, reason="timeout").inc()
+            columns[name] = None
+        elif future.exception() is not None:
+            calculator_missed_total.labels(calculator=name, reason="error").inc()
+            columns[name] = None
+        else:
+            columns[name] = future.result()
+    return columns
+
+
+def active_calculators():
+    retired = retired_calculators()
+    return [c for c in CALCULATORS if c not in retired]
+
+
+def execute_voting_batch(amounts):
+    """Vota una lista de montos: cada calculadora se evalua una vez sobre los montos del lote
+    que no estan en cache y luego se recorren las filas en orden aplicando retiros, igual que
+    mensaje a mensaje.
+    """
+    available = active_calculators()
+    values = {}
+
+    def evaluate(names, pending):
+        pending = [amount for amount in dict.fromkeys(pending) if any((n, amount) not in values for n in names)]
+        if not pending:
+            return
+        columns = evaluate_calculators(names, pending)
+        for name in names:
+            for idx, amount in enumerate(pending):
+                values[(name, amount)] = None if columns[name] is None else columns[name][idx]
+
+    evaluated_for = tuple(available)
+    evaluate(available, [amount for amount in amounts if not _vote_cache.contains((evaluated_for, amount))])
+    votes = []
+    for row, amount in enumerate(amounts):
+        if len(available) < 2:
+            # Fallback de seguridad: si se retiraron 2 calculadoras, vuelve a habilitarlas.
+            reinstate_calculators()
+            available = list(CALCULATORS)
+
+        cache_key = (tuple(available), amount)
+        cached = _vote_cache.get(cache_key)
+        if cached is not None:
+            votes.append(
+                {**cached, "divergence": False, "quorum": True, "retiredNow": [], "activeCalculators": list(available)}
+            )
+            continue
+
+        # Si cambio el conjunto activo a mitad de lote, se evaluan de una vez las filas restantes
+        # que tampoco estan en cache con el conjunto nuevo; si no, solo esta fila (no-op si ya
+        # se evaluo al inicio, cuenta si la cache la desalojo durante el lote)
+        if tuple(available) != evaluated_for:
+            evaluated_for = tuple(available)
+            evaluate(available, [rest for rest in amounts[row:] if not _vote_cache.contains((evaluated_for, rest))])
+        evaluate(available, [amount])
+        results = {calc: values[(calc, amount)] for calc in available}
+        grouped = {}
+        for calc, value in results.items():
+            if value is not None:
+                grouped.setdefault(value, []).append(calc)
+        majority_value = max(grouped, key=lambda value: len(grouped[value]), default=None)
+        if majority_value is None or len(grouped[majority_value]) <= len(available) // 2:
+            # Sin mayoria estricta de las activas (p.ej. una sin responder y dos en desacuerdo)
+            # no se valida el monto ni se retira a nadie: no hay forma de saber quien fallo
+            votes.append(
+                {
+                    "results": results,
+                    "majorityValue": None,
+                    "majorityGroup": [],
+                    "divergence": True,
+                    "quorum": False,
+                    "reason": "no_quorum" if grouped else "no_calculator_response",
+                    "retiredNow": [],
+                    "activeCalculators": list(available),
+                }
+            )
+            continue
+
+        # Quien no respondio a tiempo cuenta como voto disidente
+        dissenters = [calc for calc, value in results.items() if value != majority_value]
+        divergence = bool(dissenters)
+        retired_now = []
+        for calc in dissenters:
+            if retire_calculator(calc):
+                retired_calculators_total.labels(calculator=calc).inc()
+                retired_now.append(calc)
+        if divergence:
+            available = active_calculators()
+        else:
+            # Solo se memoizan votos unanimes: los divergentes cambian el conjunto activo
+            _vote_cache.put(
+                cache_key,
+                {"results": results, "majorityValue": majority_value, "majorityGroup": grouped[majority_value]},
+            )
+
+        votes.append(
             {
-                "eventType": "PaymentValidated",
-                "reservationId": reservation_id,
-                "correlationId": correlation_id,
-                "amount": vote["majorityValue"],          # monto final por mayoría (2/3)
-                "originalAmount": original_amount,
-                "divergence": vote["divergence"],
-                "retiredCalculators": vote["retiredNow"],
-                "activeCalculators": vote["activeCalculators"],
-                "timestamp": now_iso(),
-            },
+                "results": results,
+                "majorityValue": majority_value,
+                "majorityGroup": grouped[majority_value],
+                "divergence": divergence,
+                "quorum": True,
+                "retiredNow": retired_now,
+                "activeCalculators": list(available),
+            }
         )
 
-        # 2) Telemetría/alertas: se mantiene el stream para la validación
-        base_payload = {
-            "reservationId": reservation_id,
-            "correlationId": correlation_id,
-            "amount": original_amount,
-            "majorityValue": vote["majorityValue"],
-            "activeCalculators": vote["activeCalculators"],
-            "timestamp": now_iso(),
-        }
+    active_calculators_gauge.set(len(available))
+    return votes
 
-        if vote["divergence"]:
-            validation_divergence_total.inc()
-            publish(
+
+def execute_voting(amount: float):
+    return execute_voting_batch([amount])[0]
+
+
+def vote_messages(event, vote):
+    """Eventos de salida de una validacion, listos para rabbit.publish_async."""
+    reservation_id = event.get("reservationId")
+    original_amount = float(event.get("amount", 0.0))
+    correlation_id = event.get("correlationId", reservation_id)
+    timestamp = now_iso()
+
+    if not vote["quorum"]:
+        # Sin quorum el pedido va a la DLQ tal cual: un replay lo re-inyecta en
+        # payment.requested y se vuelve a votar, en vez de reintentarlo en bucle aqui
+        validation_no_quorum_total.labels(reason=vote["reason"]).inc()
+        validation_divergence_total.inc()
+        return [
+            ("payments.dlq", "payment.failed", {**event, "reason": vote["reason"]}),
+            (
                 "payments.events",
                 "validation.divergence",
                 {
                     "eventType": "ValidationDivergenceAlert",
+                    "reservationId": reservation_id,
+                    "correlationId": correlation_id,
+                    "amount": original_amount,
+                    "majorityValue": None,
+                    "quorum": False,
+                    "reason": vote["reason"],
                     "resultsByCalculator": vote["results"],
-                    "retiredCalculators": vote["retiredNow"],
-                    **base_payload,
+                    "retiredCalculators": [],
+                    "activeCalculators": vote["activeCalculators"],
+                    "timestamp": timestamp,
                 },
-            )
+            ),
+        ]
+
+    # 1) Evento que habilita el cobro real (pagos consume ESTE)
+    validated = (
+        "booking.events",
+        "payment.validated",
+        {
+            "eventType": "PaymentValidated",
+            "reservationId": reservation_id,
+            "correlationId": correlation_id,
+            "amount": vote["majorityValue"],          # monto final por mayoría (2/3)
+            "originalAmount": original_amount,
+            "divergence": vote["divergence"],
+            "retiredCalculators": vote["retiredNow"],
+            "activeCalculators": vote["activeCalculators"],
+            "timestamp": timestamp,
+        },
+    )
+
+    # 2) Telemetría/alertas: se mantiene el stream para la validación
+    base_payload = {
+        "reservationId": reservation_id,
+        "correlationId": correlation_id,
+        "amount": original_amount,
+        "majorityValue": vote["majorityValue"],
+        "activeCalculators": vote["activeCalculators"],
+        "timestamp": timestamp,
+    }
+
+    if vote["divergence"]:
+        validation_divergence_total.inc()
+        outcome = (
+            "payments.events",
+            "validation.divergence",
+            {
+                "eventType": "ValidationDivergenceAlert",
+                "resultsByCalculator": vote["results"],
+                "retiredCalculators": vote["retiredNow"],
+                **base_payload,
+            },
+        )
+    else:
+        validation_ok_total.inc()
+        outcome = (
+            "payments.events",
+            "validation.succeeded",
+            {
+                "eventType": "ValidationSucceeded",
+                "resultsByCalculator": vote["results"],
+                **base_payload,
+            },
+        )
+    return [validated, outcome]
+
+
+def settle_tags(ch, tags, error=None):
+    """ack (o nack con requeue si hubo error) de cada entrega por separado; nunca multiple:
+    cubriria entregas de otros lotes que siguen esperando sus confirms.
+    """
+    if not ch.is_open:
+        return
+    for tag in tags:
+        if error is None:
+            rabbit.ack(ch, tag)
         else:
-            validation_ok_total.inc()
-            publish(
-                "payments.events",
-                "validation.succeeded",
-                {
-                    "eventType": "ValidationSucceeded",
-                    "resultsByCalculator": vote["results"],
-                    **base_payload,
-                },
-            )
-    finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+            rabbit.nack(ch, tag)
+
 
+def settle_deliveries(ch, tags, label):
+    """on_done de rabbit.publish_async: ack de las entregas cuando el broker confirmo sus
+    eventos, nack con requeue si no (at-least-once).
 
-def on_health_ping(ch, method, _properties, body):
+    Corre en el hilo de IO del publicador y pika no es thread-safe: el ack se agenda en la
+    conexion del consumidor. Va tag por tag porque los lotes pueden confirmarse fuera de
+    orden en canales distintos y un ack multiple cubriria entregas aun sin confirmar.
+    """
+
+    def on_done(error):
+        if error is not None:
+            app.logger.warning("%s no publicado: %s", label, error)
+        try:
+            ch.connection.add_callback_threadsafe(lambda: settle_tags(ch, tags, error))
+        except Exception as exc:
+            # Conexion de consumo caida: RabbitMQ ya reentrega esas entregas
+            app.logger.warning("%s sin ack (consumidor reconectando): %s", label, exc)
+
+    return on_done
+
+
+def flush_validation_batch(ch, from_timer=False):
+    global _validation_batch, _validation_batch_timer
+    if _validation_batch_timer is not None and not from_timer:
+        ch.connection.remove_timeout(_validation_batch_timer)
+    _validation_batch_timer = None
+    batch, _validation_batch = _validation_batch, []
+    if not batch:
+        return
+
+    tags = [tag for tag, _event in batch]
     try:
-        ping = json.loads(body.decode("utf-8"))
-        pong = {
-            "eventType": "HealthPong",
-            "service": APP_NAME,
-            "pingId": ping.get("pingId"),
-            "timestamp": now_iso(),
-        }
-        publish("control.pong", "health.pong", pong)
-        validator_heartbeat_total.inc()
-    finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        votes = execute_voting_batch([float(event.get("amount", 0.0)) for _tag, event in batch])
+        messages = []
+        for (_tag, event), vote in zip(batch, votes):
+            messages.extend(vote_messages(event, vote))
+        # El consumidor sigue sin esperar: el ack de cada entrega sale cuando el broker
+        # confirma el lote, mientras tanto la ventana de prefetch acota lo que queda en vuelo
+        rabbit.publish_async(
+            messages,
+            settle_deliveries(ch, tags, f"Lote de {len(batch)} validaciones"),
+        )
+    except Exception as exc:
+        # Sin ack: el lote vuelve a la cola (at-least-once); solo sus propias entregas
+        app.logger.warning("Lote de %s validaciones no procesado: %s", len(batch), exc)
+        settle_tags(ch, tags, exc)
 
 
-def consumer_worker():
-    while True:
+def on_validation_requested(ch, method, _properties, body):
+    global _validation_batch_timer
+    deferred = False
+    try:
+        event = json.loads(body.decode("utf-8"))
+        validation_requests_total.inc()
+
+        if VALIDATION_BATCH_SIZE > 1:
+            # El ack queda diferido hasta publicar los eventos del lote
+            _validation_batch.append((method.delivery_tag, event))
+            deferred = True
+            if len(_validation_batch) >= VALIDATION_BATCH_SIZE:
+                flush_validation_batch(ch)
+            elif _validation_batch_timer is None:
+                _validation_batch_timer = ch.connection.call_later(
+                    VALIDATION_BATCH_MAX_WAIT_MS / 1000.0,
+                    lambda: flush_validation_batch(ch, from_timer=True),
+                )
+            return
+
+        vote = execute_voting(float(event.get("amount", 0.0)))
+        label = f"Validacion {event.get('reservationId')}"
+        deferred = True
         try:
-            connection = rabbit_connection()
-            channel = connection.channel()
-            setup_topology(channel)
-            channel.basic_qos(prefetch_count=20)
-            channel.basic_consume(queue="validator.requested", on_message_callback=on_validation_requested)
-            channel.basic_consume(queue="validator.monitor", on_message_callback=on_health_ping)
-            app.logger.info("Consumidor RabbitMQ de validador activo")
-            channel.start_consuming()
+            rabbit.publish_async(vote_messages(event, vote), settle_deliveries(ch, [method.delivery_tag], label))
         except Exception as exc:
-            app.logger.warning("Consumidor validador reiniciando: %s", exc)
-            time.sleep(2)
+            # Sin canal de publicacion: se devuelve a la cola en vez de perder el evento
+            app.logger.warning("%s no publicada: %s", label, exc)
+            rabbit.nack(ch, method.delivery_tag)
+    finally:
+        if not deferred:
+            rabbit.ack(ch, method.delivery_tag)
+
+
+def reset_validation_batch(_channel):
+    global _validation_batch, _validation_batch_timer
+    # Lo pendiente de un canal caido lo reentrega RabbitMQ
+    _validation_batch = []
+    _validation_batch_timer = None
+
+
+def consumer_worker():
+    rabbit.consume(
+        {"validator.requested": on_validation_requested},
+        CONSUMER_PREFETCH,
+        on_connect=reset_validation_batch,
+    )
+
+
+def health_worker():
+    rabbit.consume_health(
+        health_queue_name("validator.monitor"), SATURATION_BUSY_SECS, on_pong=validator_heartbeat_total.inc
+    )
 
 
 @app.get("/status")
@@ -256,8 +662,8 @@ def status():
         {
             "service": APP_NAME,
             "faultyCalculator": FAULTY_CALCULATOR,
-            "retiredCalculators": sorted(list(_retired_calculators)),
-            "activeCalculators": [c for c in ["calc_a", "calc_b", "calc_c"] if c not in _retired_calculators],
+            "retiredCalculators": sorted(retired_calculators()),
+            "activeCalculators": active_calculators(),
         }
     )
 
@@ -273,10 +679,19 @@ def metrics():
 
 
 def bootstrap():
-    active_calculators_gauge.set(3)
-    connect_publish_channel()
-    thread = threading.Thread(target=consumer_worker, daemon=True)
-    thread.start()
+    load_calculators()
+    threads = [
+        threading.Thread(target=consumer_worker, daemon=True),
+        threading.Thread(target=health_worker, daemon=True),
+    ]
+    if SHARED_RETIRED_STATE:
+        sync_retired_view()
+        threads.append(threading.Thread(target=retired_sync_worker, daemon=True))
+    else:
+        set_retired_view(())
+    rabbit.start()
+    for thread in threads:
+        thread.start()
 
 
 if __name__ == "__main__":
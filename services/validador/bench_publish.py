@@ -0,0 +1,139 @@
+"""Benchmark de extremo a extremo del validador contra un RabbitMQ real: votar y publicar los
+dos eventos de cada validacion, en mensajes publicados por segundo.
+
+  antes        por mensaje, dos basic_publish persistentes bajo lock y sin confirms (camino original)
+  confirm/msg  por mensaje, los mismos publish esperando cada confirm (BlockingChannel)
+  despues      votacion por lotes + publish_async con confirms por lote; los lotes en vuelo
+               los acota la ventana de prefetch, igual que en el consumidor
+
+Publica en un exchange propio (bench.validator) hacia una cola durable que se borra al final:
+no llega a pagos ni a reservas.
+
+Uso: RABBIT_HOST=localhost python bench_publish.py [--messages 20000] [--window 20] [--prefetch 20]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+# Estado de retiradas local, sin Redis
+os.environ.setdefault("SHARED_RETIRED_STATE", "0")
+# services/common, igual que en la imagen
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pika  # noqa: E402
+
+import app  # noqa: E402
+
+BENCH_EXCHANGE = "bench.validator"
+BENCH_QUEUE = "bench.validator.sink"
+
+
+def declare_sink(channel):
+    channel.exchange_declare(exchange=BENCH_EXCHANGE, exchange_type="fanout", auto_delete=True)
+    channel.queue_declare(queue=BENCH_QUEUE, durable=True)
+    channel.queue_bind(exchange=BENCH_EXCHANGE, queue=BENCH_QUEUE)
+
+
+def bench_messages(event, vote):
+    return [(BENCH_EXCHANGE, routing_key, payload) for _exchange, routing_key, payload in app.vote_messages(event, vote)]
+
+
+def run(label, fn, events, args):
+    app.set_retired_view(())
+    app._vote_cache.clear()
+    start = time.perf_counter()
+    published = fn(events, args)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<12} {published / elapsed:>10,.0f} msgs/s  ({len(events) / elapsed:,.0f} validaciones/s, {elapsed:.2f} s)")
+    return published / elapsed
+
+
+def per_message(events, confirm):
+    connection = app.rabbit.open_connection()
+    channel = connection.channel()
+    declare_sink(channel)
+    if confirm:
+        channel.confirm_delivery()
+    lock = threading.Lock()
+    properties = pika.BasicProperties(content_type="application/json", delivery_mode=2)
+    published = 0
+    for event in events:
+        vote = app.execute_voting(float(event["amount"]))
+        for exchange, routing_key, payload in bench_messages(event, vote):
+            with lock:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=json.dumps(payload).encode("utf-8"),
+                    properties=properties,
+                )
+            published += 1
+    # Cerrar vacia el socket: lo publicado sin confirms tambien llego al broker
+    connection.close()
+    return published
+
+
+def before(events, _args):
+    return per_message(events, confirm=False)
+
+
+def confirm_each(events, _args):
+    return per_message(events, confirm=True)
+
+
+def after(events, args):
+    # Lotes sin confirmar a la vez: los que caben en la ventana de prefetch del consumidor
+    in_flight = max(1, args.prefetch // args.window)
+    slots = threading.BoundedSemaphore(in_flight)
+    errors = []
+
+    def on_done(error):
+        if error is not None:
+            errors.append(error)
+        slots.release()
+
+    published = 0
+    for idx in range(0, len(events), args.window):
+        chunk = events[idx : idx + args.window]
+        votes = app.execute_voting_batch([float(event["amount"]) for event in chunk])
+        messages = []
+        for event, vote in zip(chunk, votes):
+            messages.extend(bench_messages(event, vote))
+        slots.acquire()
+        app.rabbit.publish_async(messages, on_done)
+        published += len(messages)
+    for _ in range(in_flight):
+        slots.acquire()
+    if errors:
+        raise errors[0]
+    return published
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000, help="validaciones (2 mensajes cada una)")
+    parser.add_argument("--window", type=int, default=20, help="validaciones por lote")
+    parser.add_argument("--prefetch", type=int, default=app.CONSUMER_PREFETCH)
+    args = parser.parse_args()
+    app.load_calculators()
+    app.rabbit.start()
+
+    prices = [round(random.uniform(50, 500), 2) for _ in range(50)]
+    events = [{"reservationId": f"bench-{idx}", "amount": random.choice(prices)} for idx in range(args.messages)]
+
+    base = run("antes", before, events, args)
+    naive = run("confirm/msg", confirm_each, events, args)
+    batched = run("despues", after, events, args)
+    print(f"speedup      {batched / base:.2f}x vs antes, {batched / naive:.2f}x vs confirm/msg")
+
+    connection = app.rabbit.open_connection()
+    connection.channel().queue_delete(queue=BENCH_QUEUE)
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
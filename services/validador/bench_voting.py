@@ -0,0 +1,59 @@
+"""Microbenchmark: votacion mensaje a mensaje vs por lotes (ventana de prefetch).
+
+Uso: python bench_voting.py [--messages 100000] [--window 20]
+
+Mide la votacion sin cache de votos; con VOTE_CACHE_SIZE=10000 mide tambien el efecto de la
+cache (con pocos precios distintos casi todo son aciertos).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+# El benchmark mide solo la votacion: estado de retiradas local, sin Redis
+os.environ.setdefault("SHARED_RETIRED_STATE", "0")
+os.environ.setdefault("VOTE_CACHE_SIZE", "0")
+# services/common, igual que en la imagen
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def run(label, fn, amounts, window):
+    app.set_retired_view(())
+    app._vote_cache.clear()
+    start = time.perf_counter()
+    fn(amounts, window)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<12} {len(amounts) / elapsed:>12,.0f} votos/s  ({elapsed * 1000:.1f} ms)")
+    return elapsed
+
+
+def per_message(amounts, _window):
+    for amount in amounts:
+        app.execute_voting(amount)
+
+
+def batched(amounts, window):
+    for idx in range(0, len(amounts), window):
+        app.execute_voting_batch(amounts[idx : idx + window])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--window", type=int, default=app.CONSUMER_PREFETCH)
+    args = parser.parse_args()
+    app.load_calculators()
+
+    prices = [round(random.uniform(50, 500), 2) for _ in range(50)]
+    amounts = [random.choice(prices) for _ in range(args.messages)]
+
+    base = run("por mensaje", per_message, amounts, args.window)
+    batch = run("por lotes", batched, amounts, args.window)
+    print(f"speedup      {base / batch:.2f}x")
+
+
+if __name__ == "__main__":
+    main()